@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+"""Measures the fabfile's own orchestration overhead against a simulated
+cluster, so scaling regressions show up without real VMs.
+
+run, put, get, local, rsync_project and upload_template are swapped for
+stand-ins that answer like freshly imaged hosts after a configurable delay,
+and the cluster lives on platforms.simulated. Each task and cluster size
+runs in its own process (the fabfile sets up hosts, pools and sync state
+when imported) from a scratch directory under tmp/benchmark.
+
+    python benchmark.py --save        # record a baseline
+    python benchmark.py               # compare against it
+    python benchmark.py --hosts 4 --tasks refresh_config
+"""
+import hashlib
+import json
+import re
+import socket
+import sys
+
+from argparse import ArgumentParser, SUPPRESS
+from collections import defaultdict
+from fnmatch import fnmatch
+from glob import glob
+from multiprocessing import Value
+from os import environ, getpid, makedirs, symlink, urandom, walk
+from os.path import abspath, basename, dirname, exists, getsize, isdir, \
+    join, relpath
+from shutil import rmtree
+from subprocess import Popen, PIPE, STDOUT, call
+from threading import Thread
+from time import sleep, time
+from zlib import crc32
+
+from fabric.api import env
+
+
+ROOT = dirname(abspath(__file__))
+
+TASKS = ['rebuild_cluster', 'refresh_code', 'refresh_config', 'swift_restart']
+HOST_COUNTS = [4, 50, 500]
+
+# Keep in sync with fablib.batch.MARKER.
+BATCH_STEP = re.compile(r'echo "__BATCH_STEP__ (\d+) \$__s"')
+MISSING_PATHS = re.compile(r'for __p in (.*?); do')
+# Keep in sync with fablib.bundle.REMOTE_FILES.
+FILE_STATE = re.compile(r"^python - (.*?) <<'EOF'\n.*sums, contents", re.S)
+
+# What the stand-ins pretend a freshly imaged Debian host looks like, for
+# the commands whose output the fabfile acts on.
+HASH_SUFFIX = '5f0e5c9bd1a2c3e4'
+ABSENT_PATHS = ['/etc/rc.conf', '/usr/local/bin/zsh']
+REMOTE_FILES = {
+    '/etc/swift/swift.conf': '[swift-hash]\nswift_hash_path_suffix = %s\n' %
+                             HASH_SUFFIX,
+    '/etc/swift/account.ring.gz': 32 * 1024,
+    '/etc/swift/container.ring.gz': 32 * 1024,
+    '/etc/swift/object.ring.gz': 32 * 1024,
+}
+RESPONSES = [
+    (re.compile(r'^ls -1 /dev/sd'), '/dev/sdb\n/dev/sdc', 0),
+    (re.compile(r'^grep (swift_hash_path_suffix|super_admin_key) '),
+     HASH_SUFFIX, 0),
+    # upload_template checks whether its destination is a directory.
+    (re.compile(r'^test -d \S*\.(conf|gz)\W*$'), '', 1),
+]
+# Local commands that would need a real cluster.
+SIMULATED_LOCAL = re.compile(r'\.functests')
+
+
+class Result(str):
+    """Looks like what fabric's run() and local() return."""
+
+    def __new__(cls, output='', return_code=0):
+        result = str.__new__(cls, output)
+        result.return_code = return_code
+        result.succeeded = return_code == 0
+        result.failed = not result.succeeded
+        result.stderr = ''
+        return result
+
+
+def simulated_address(host):
+    n = crc32(host) & 0xffffff
+    return '10.%d.%d.%d' % (n >> 16, (n >> 8) & 0xff, n & 0xff)
+
+
+class SimulatedNetwork(object):
+    """Stand-ins for Fabric's remote operations. Every call pays latency,
+    the first call to a host in each worker pays for the SSH handshake, and
+    transfers queue for one shared uplink, like a workstation's. Calls are
+    recorded as 'sim.*' spans on the tracer, which is where call counts and
+    bytes moved are read back from."""
+
+    def __init__(self, latency, bandwidth, connect):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.connect = connect
+        self.tracer = None
+        # Created before Fabric forks, so every worker shares the uplink.
+        self._link = Value('d', 0.0)
+        self._connected = set()
+        self._local = None
+
+    def install(self):
+        """Swaps the stand-ins in. This has to happen before fablib or the
+        fabfile are imported, since they bind these names at import."""
+        from fabric import api
+        from fabric.contrib import files, project
+
+        self._local = api.local
+        api.run = api.sudo = files.run = files.sudo = self.run
+        api.put = files.put = self.put
+        api.get = self.get
+        api.local = self.local
+        project.rsync_project = self.rsync_project
+        socket.gethostbyname = simulated_address
+
+        import fablib.probe
+        from fablib.trace import tracer
+
+        fablib.probe.port_open = lambda *args, **kwargs: True
+        self.tracer = tracer
+
+    def _call(self, kind, name, size=0):
+        start = time()
+        if env.host_string not in self._connected:
+            self._connected.add(env.host_string)
+            sleep(self.connect)
+            self.tracer.record(env.host_string, 'sim.connect', start, time())
+            start = time()
+
+        delay = self.latency
+        if size:
+            with self._link.get_lock():
+                begin = max(time(), self._link.value)
+                self._link.value = begin + size / self.bandwidth
+                delay += self._link.value - time()
+        sleep(max(delay, 0))
+
+        self.tracer.record(name, 'sim.' + kind, start, time(), bytes=size)
+
+    def respond(self, command):
+        steps = BATCH_STEP.findall(command)
+        if steps:
+            return Result('\n'.join('__BATCH_STEP__ %s 0' % step
+                                    for step in steps))
+
+        state = FILE_STATE.search(command)
+        if state:
+            return Result(self.file_state(re.findall(r"'([^']*)'",
+                                                     state.group(1))))
+
+        if command.endswith('echo $__missing'):
+            paths = re.findall(r"'([^']*)'",
+                               MISSING_PATHS.search(command).group(1))
+            return Result(' '.join(p for p in paths if p in ABSENT_PATHS))
+
+        for pattern, output, status in RESPONSES:
+            if pattern.search(command):
+                return Result(output, status)
+        return Result()
+
+    def file_state(self, args):
+        sums = {}
+        contents = {}
+        for arg in args:
+            path = arg.lstrip('+')
+            content = REMOTE_FILES.get(path)
+            if not isinstance(content, str):
+                sums[path] = None
+                continue
+            sums[path] = hashlib.sha1(content).hexdigest()
+            if arg.startswith('+'):
+                contents[path] = content
+        return json.dumps({'sums': sums, 'contents': contents})
+
+    def run(self, command, *args, **kwargs):
+        self._call('run', command)
+        return self.respond(command)
+
+    def put(self, local_path=None, remote_path=None, *args, **kwargs):
+        if hasattr(local_path, 'getvalue'):
+            size = len(local_path.getvalue())
+            remote = [remote_path]
+        else:
+            paths = glob(local_path)
+            size = sum(getsize(p) for p in paths)
+            remote = [join(remote_path, basename(p)) for p in paths]
+
+        self._call('put', 'put %s' % remote_path, size)
+        return remote
+
+    def get(self, remote_path, local_path=None, *args, **kwargs):
+        paths = [p for p in sorted(REMOTE_FILES) if fnmatch(p, remote_path)]
+        local = []
+        size = 0
+
+        for path in paths or [remote_path]:
+            content = REMOTE_FILES.get(path, 1024)
+            if isinstance(content, int):
+                content = urandom(content)
+
+            target = local_path or basename(path)
+            if isdir(target):
+                target = join(target, basename(path))
+            with open(target, 'wb') as f:
+                f.write(content)
+
+            local.append(target)
+            size += len(content)
+
+        self._call('get', 'get %s' % remote_path, size)
+        return local
+
+    def rsync_project(self, remote_dir, local_dir=None, *args, **kwargs):
+        paths = [join(d, f) for d, _, files in walk(local_dir) for f in files]
+        self._call('rsync', 'rsync %s' % local_dir,
+                   sum(getsize(p) for p in paths))
+        return Result('\n'.join('>f+++++++++ %s' % relpath(p, local_dir)
+                                for p in paths))
+
+    def local(self, command, capture=False, shell=None):
+        if SIMULATED_LOCAL.search(command):
+            return Result()
+        return self._local(command, capture=capture, shell=shell)
+
+
+class MemorySampler(Thread):
+    """Samples the combined resident memory of this process and every
+    worker Fabric forks from it. Shared pages count once per process, so
+    this is an upper bound."""
+
+    def __init__(self, interval=0.25):
+        Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = 0
+        self._running = True
+
+    def sample(self):
+        output = Popen(['ps', '-A', '-o', 'pid=,ppid=,rss='],
+                       stdout=PIPE).communicate()[0]
+        children = defaultdict(list)
+        rss = {}
+        for line in output.splitlines():
+            pid, ppid, kb = [int(field) for field in line.split()]
+            children[ppid].append(pid)
+            rss[pid] = kb
+
+        total = 0
+        pending = [getpid()]
+        while pending:
+            pid = pending.pop()
+            total += rss.get(pid, 0)
+            pending.extend(children[pid])
+        return total
+
+    def run(self):
+        while self._running:
+            self.peak = max(self.peak, self.sample())
+            sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+        self.join()
+        return self.peak
+
+
+def cluster_hosts(count):
+    return ['bench%d.stack.local' % x for x in range(1, count + 1)]
+
+
+def measure(events):
+    calls = defaultdict(int)
+    moved = 0
+    for event in events:
+        if event['cat'].startswith('sim.'):
+            calls[event['cat'][4:]] += 1
+            moved += event['args'].get('bytes', 0)
+    return dict(calls), moved
+
+
+def worker(args):
+    """Runs one task inside a scratch directory prepared by benchmark()."""
+    network = SimulatedNetwork(args.latency_ms / 1000.0,
+                               args.bandwidth_mbps * 125000.0,
+                               args.connect_ms / 1000.0)
+    network.install()
+
+    from fabric.api import execute
+    env.hosts = cluster_hosts(args.hosts)
+
+    # Loading profiles, topology and everything the fabfile imports, which
+    # every fab command pays for before any task runs.
+    started = time()
+    import fabfile
+    startup = time() - started
+
+    sampler = MemorySampler()
+    sampler.start()
+
+    failed = False
+    started = time()
+    try:
+        execute(getattr(fabfile, args.worker))
+    except SystemExit:
+        failed = True
+    wall = time() - started
+    peak = sampler.stop()
+
+    events = network.tracer.events()
+    network.tracer.finish(report=False)
+    calls, moved = measure(events)
+
+    with open('result.json', 'w') as f:
+        json.dump({'task': args.worker,
+                   'hosts': args.hosts,
+                   'failed': failed,
+                   'startup_secs': round(startup, 3),
+                   'wall_secs': round(wall, 3),
+                   'calls': calls,
+                   'bytes': moved,
+                   'peak_rss_mb': round(peak / 1024.0, 1),
+                   'trace': abspath(network.tracer.path)}, f, indent=4)
+
+
+def make_packages(path, packages, size_kb):
+    """Creates stand-in source trees for the profile's packages, each about
+    size_kb of incompressible files."""
+    for pkg, _, _ in packages:
+        tree = join(path, pkg)
+        if exists(tree):
+            continue
+
+        makedirs(join(tree, pkg))
+        with open(join(tree, 'setup.py'), 'w') as f:
+            f.write("from setuptools import setup\nsetup(name='%s')\n" % pkg)
+        for x in xrange(max(size_kb / 64, 1)):
+            with open(join(tree, pkg, 'module%d.py' % x), 'wb') as f:
+                f.write(urandom(64 * 1024))
+
+
+def prepare(directory, work, args):
+    profile = json.load(open(join(ROOT, 'profiles',
+                                  '%s.json' % args.profile)))
+    profile['platform'] = ['platforms.simulated', 'SimulatedPlatform']
+    profile['platform_options'] = {'vmhost_count': args.vmhosts,
+                                   'api_secs': args.api_secs,
+                                   'reimage_secs': args.reimage_secs}
+
+    make_packages(work, profile['packages'], args.package_kb)
+
+    rmtree(directory, ignore_errors=True)
+    makedirs(join(directory, 'profiles'))
+    makedirs(join(directory, 'tmp'))
+    symlink(join(ROOT, 'config'), join(directory, 'config'))
+    symlink(work, join(directory, 'work'))
+    with open(join(directory, 'profiles', 'simulated.json'), 'w') as f:
+        json.dump(profile, f, indent=4)
+
+
+def run_scenario(task, hosts, args, argv):
+    directory = abspath(join(args.output, '%s-%d' % (task, hosts)))
+    prepare(directory, abspath(join(args.output, 'work')), args)
+
+    variables = dict(environ,
+                     SWIFT_CLUSTER_PROFILE='simulated',
+                     SWIFT_CLUSTER_NAME='bench',
+                     SWIFT_TEST_CONFIG_FILE='test.conf',
+                     SWIFT_DEPLOY_MODE=args.deploy_mode,
+                     SWIFT_DISTRIBUTION='direct',
+                     SWIFT_TRACE='1')
+    with open(join(directory, 'benchmark.log'), 'w') as log:
+        call([sys.executable, abspath(__file__), '--worker', task,
+              '--hosts', str(hosts)] + argv,
+             cwd=directory, env=variables, stdout=log, stderr=STDOUT)
+
+    try:
+        return json.load(open(join(directory, 'result.json')))
+    except IOError:
+        return {'task': task, 'hosts': hosts, 'failed': True}
+
+
+def options(args):
+    return dict((name, getattr(args, name))
+                for name in ('latency_ms', 'bandwidth_mbps', 'connect_ms',
+                             'api_secs', 'reimage_secs', 'vmhosts',
+                             'package_kb', 'profile', 'deploy_mode'))
+
+
+def compare(result, base, tolerance):
+    """Returns (notes, regressed) for result against its baseline."""
+    if not base:
+        return '', False
+
+    notes = []
+    regressed = False
+
+    for name, key in (('wall', 'wall_secs'), ('startup', 'startup_secs')):
+        if key not in base:
+            continue
+        change = (result[key] - base[key]) / max(base[key], 0.001)
+        notes.append('%+.0f%% %s' % (change * 100, name))
+        if change > tolerance:
+            regressed = True
+
+    calls = sum(result['calls'].values()) - sum(base['calls'].values())
+    if calls:
+        notes.append('%+d calls' % calls)
+    if calls > 0:
+        regressed = True
+
+    if regressed:
+        notes.append('REGRESSION')
+    return ', '.join(notes), regressed
+
+
+def benchmark(args, argv):
+    baseline = {}
+    if exists(args.baseline):
+        baseline = json.load(open(args.baseline))
+        if baseline.get('options') != options(args):
+            print 'Warning: baseline was recorded with other options:'
+            print '\t%s' % json.dumps(baseline.get('options'), sort_keys=True)
+
+    row = '%-16s %6s %9s %9s %7s %9s %9s  %s'
+    print row % ('task', 'hosts', 'startup s', 'wall s', 'calls', 'moved MB',
+                 'peak MB', 'vs baseline')
+
+    results = {}
+    failures = 0
+    for hosts in args.hosts:
+        for task in args.tasks:
+            result = run_scenario(task, hosts, args, argv)
+            key = '%s/%d' % (task, hosts)
+            results[key] = result
+
+            if result['failed']:
+                failures += 1
+                print row % (task, hosts, '-', '-', '-', '-', '-',
+                             'FAILED, see %s' % join(args.output, '%s-%d' %
+                                                     (task, hosts),
+                                                     'benchmark.log'))
+                continue
+
+            notes, regressed = compare(
+                result, baseline.get('results', {}).get(key), args.tolerance)
+            failures += regressed
+            print row % (task, hosts, '%.3f' % result['startup_secs'],
+                         '%.2f' % result['wall_secs'],
+                         sum(result['calls'].values()),
+                         '%.1f' % (result['bytes'] / 1048576.0),
+                         '%.0f' % result['peak_rss_mb'], notes)
+            sys.stdout.flush()
+
+    if args.save:
+        if baseline.get('options') != options(args):
+            baseline = {'options': options(args), 'results': {}}
+        baseline['results'].update(
+            (key, r) for key, r in results.items() if not r['failed'])
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print 'Baseline saved to %s' % args.baseline
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the fabfile against a '
+                                        'simulated cluster.')
+    parser.add_argument('--hosts', type=int, nargs='+', default=HOST_COUNTS)
+    parser.add_argument('--tasks', nargs='+', choices=TASKS, default=TASKS)
+    parser.add_argument('--latency-ms', type=float, default=20,
+                        help='round trip of every remote call')
+    parser.add_argument('--bandwidth-mbps', type=float, default=100,
+                        help='workstation uplink shared by all transfers')
+    parser.add_argument('--connect-ms', type=float, default=60,
+                        help='SSH handshake, paid once per host and worker')
+    parser.add_argument('--api-secs', type=float, default=0.05,
+                        help='platform lookups')
+    parser.add_argument('--reimage-secs', type=float, default=1.0)
+    parser.add_argument('--vmhosts', type=int, default=11)
+    parser.add_argument('--package-kb', type=int, default=2048,
+                        help='size of each stand-in source package')
+    parser.add_argument('--profile', default='debian-6-libvirt',
+                        help='profile the simulated one is based on')
+    parser.add_argument('--deploy-mode', choices=['source', 'rsync'],
+                        default='source')
+    parser.add_argument('--output', default='tmp/benchmark')
+    parser.add_argument('--baseline', default='tmp/benchmark/baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='wall time increase reported as a regression')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--worker', help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.hosts = args.hosts[0]
+        worker(args)
+        sys.exit(0)
+
+    if not exists(args.output):
+        makedirs(args.output)
+
+    # Passed on to the workers, which take --worker and --hosts on top.
+    argv = []
+    for name, value in sorted(options(args).items()):
+        argv.extend(['--%s' % name.replace('_', '-'), str(value)])
+
+    sys.exit(benchmark(args, argv))
@@ -1,24 +1,41 @@
+import hashlib
 import json
+import re
 import sys
 
 from glob import glob
-from os import environ, remove, listdir
-from os.path import exists
-from time import sleep
+from os import environ, lstat, remove, rename, symlink, makedirs, walk
+from os.path import exists, abspath, basename, islink, join
+from time import sleep, time
 from socket import gethostbyname
 from shutil import copytree, rmtree, ignore_patterns
-from multiprocessing import Value
 
 from fabric.api import task, serial, parallel, runs_once, \
-    run, local, cd, env, get, put, settings, hide
+    cd, env, settings, hide
 from fabric.utils import abort
+from fabric.exceptions import NetworkError
 from fabric.colors import red
-from fabric.contrib.files import upload_template, append, sed
+from fabric.contrib.files import append, sed
+from fabric.contrib.project import rsync_project
 from fabric.decorators import with_settings
 
-from fablib import execute_task_name, rexists
+from fablib import execute_task_name, rexists, rmissing, rwait_for
+from fablib.batch import CommandBatch
+from fablib.bundle import ConfigBundle, remote_files
+from fablib.probe import backoff, wait_for_hosts, wait_for_port, \
+    wait_until_healthy
+from fablib.cache import ArtifactCache, artifact_key, source_revision
+from fablib.distribute import distribute
+from fablib.scheduler import Scheduler
+from fablib.profiles import ProfileError, ProfileRegistry
+from fablib.sync import Barrier, Event, SyncTimeout, failure_sets, \
+    wait_any
+from fablib.topology import TopologyError, resolve_topology
+from fablib.graph import Step, StepGraph
+from fablib.rings import RING_PORTS, build_rings, ring_builder_available
 from fablib.decorators import retry
 from fablib.logging import log_success, log_error, log_info, log_warn
+from fablib.trace import tracer, run, local, get, put
 
 import platforms
 
@@ -26,9 +43,17 @@ import platforms
 env.PROFILE = environ.get("SWIFT_CLUSTER_PROFILE")
 env.NAME = environ.get("SWIFT_CLUSTER_NAME")
 env.TEST_CONFIG = environ.get("SWIFT_TEST_CONFIG_FILE")
+env.ARTIFACT_CACHE_MB = int(environ.get("SWIFT_ARTIFACT_CACHE_MB", 1024))
+env.DEPLOY_MODE = environ.get("SWIFT_DEPLOY_MODE", "source")
+env.DISTRIBUTION = environ.get("SWIFT_DISTRIBUTION", "direct")
+env.PACKAGE_PROXY = environ.get("SWIFT_PACKAGE_PROXY")
+env.PHASE_TIMEOUT = int(environ.get("SWIFT_PHASE_TIMEOUT", 3600))
+env.BOOT_TIMEOUT = int(environ.get("SWIFT_BOOT_TIMEOUT", 1800))
+env.RESTART_MODE = environ.get("SWIFT_RESTART_MODE", "all")
+env.RESTART_BATCH = int(environ.get("SWIFT_RESTART_BATCH", 1))
+env.HEALTH_TIMEOUT = int(environ.get("SWIFT_HEALTH_TIMEOUT", 300))
 env.host_prefix = env.NAME
 env.abort_on_prompts = True
-env.running_hosts = 0
 env.disable_known_hosts = True
 env.use_ssh_config = True
 env.user = 'root'
@@ -39,15 +64,44 @@ env.roledefs = {
 }
 
 
-running_hosts = Value('H', 0)
-packaged_code = Value('H', 0)
-total_hosts = Value('H', 0)
-tests_running = Value('H', 0)
-prep_auth_done = Value('H', 0)
-
 PlatformManager = None
 platform = None
 
+# part_power, replicas, min_part_hours
+RING_PARAMS = (12, 2, 1)
+
+RSYNC_EXCLUDES = ['build', '*.egg-info', '*.pyc']
+RSYNC_CHANGE = re.compile(r'^([<>ch]|\*deleting)', re.M)
+
+SWIFTCLIENT_URL = "git://github.com/openstack/python-swiftclient.git"
+WHEELHOUSE = "/root/wheelhouse"
+# Building and installing wheels needs pip 1.4, newer than the python-pip
+# of any profile. The upper bounds still support Python 2.6 (Debian 6).
+WHEEL_PIP = ["pip>=1.4,<9.1", "setuptools>=0.8,<37"]
+wheelhouse_hosts = set()
+
+# What to reload when a config file or package changes: swift-init server
+# globs, or None for every Swift server on the host. System services are
+# matched by prefix against the profile's proxy/storage_services, since
+# their names differ between platforms.
+CONFIG_SERVICES = {
+    "proxy-server.conf": ["proxy*"],
+    "account-server.conf": ["account*"],
+    "container-server.conf": ["container*"],
+    "object-server.conf": ["object*"],
+    "swift.conf": None,
+    "dispersion.conf": [],
+}
+CONFIG_SYSTEM_SERVICES = {
+    "rsyncd.conf": "rsync",
+    "rsyslog.conf": "rsyslog",
+}
+PACKAGE_SERVICES = {
+    "swift": None,
+    "swauth": ["proxy*"],
+    "python-swiftclient": [],
+}
+
 
 def platform_init():
     global PlatformManager
@@ -68,8 +122,13 @@ def platform_init():
                'execute_handler': execute_task_name,
                'run_handler': run,
                'host_broker_handler': host_broker_handler,
-               'rexists': rexists}
-    platform = PlatformManager(config('platform_options'), **helpers)
+               'rexists': rexists,
+               'rmissing': rmissing}
+    platform = tracer.wrap_methods(
+        PlatformManager(config('platform_options'), **helpers),
+        ['find_instance', 'get_instance', 'create_instance',
+         'reimage_instance', 'reimage_instance_os', 'delete_instance',
+         'instance_ready'])
 
 
 def host_broker_handler(vmhost):
@@ -78,27 +137,39 @@ def host_broker_handler(vmhost):
 
 
 def load_profile(profile_name):
-    profile = json.load(open("profiles/%s" % profile_name))
-
-    if 'platform' not in profile:
-        log_error('Profile %s does not include a platform key, skipping' %
-                  profile_name)
-        return None
-
-    return profile
+    """Reads and validates a profile, stopping here rather than halfway
+    through a task when it is missing or broken."""
+    try:
+        return CONFIG[profile_name]
+    except KeyError:
+        log_error('Unknown profile %s, choose from: %s' %
+                  (profile_name, ', '.join(CONFIG.names())))
+    except ProfileError as e:
+        log_error(str(e))
+    sys.exit(1)
 
 
-def hosts_by_prefix(prefix):
-    return ['%s%d.stack.local' % (prefix, d,) for d in xrange(1, 5)]
+def index_by_host(host):
+    return topology.index[host]
 
 
-def index_by_host(host):
-    return env.hosts.index(host)
+def load_topology():
+    names = env.PROFILE.split(',')
+    for name in names:
+        load_profile(name)
 
+    try:
+        topology = resolve_topology(env.host_prefix, names,
+                                    CONFIG[names[0]].get('topology'),
+                                    env.hosts)
+    except TopologyError as e:
+        log_error('Invalid topology: %s' % e)
+        sys.exit(1)
 
-def roledefs_from_hosts():
-    env.roledefs['proxy'].append(env.hosts[0])
-    env.roledefs['storage'] = env.hosts[1:]
+    # Roles may name profiles of their own.
+    for name in set(topology.profile.values()):
+        load_profile(name)
+    return topology
 
 
 # To load the correct profile and cluster name, we need
@@ -113,52 +184,96 @@ if not env.PROFILE or not env.NAME:
     sys.exit(1)
 
 
-# Load the profile into our config constant and generate
-# the hosts list. This modifies the env.
-CONFIG = {}
-
-
-for profile in listdir("profiles"):
-    p = load_profile(profile)
-    if not p:
-        continue
-
-    CONFIG[profile.split(".")[0]] = p
+# Profiles are loaded into our config constant as they are used, so only
+# the ones this cluster names are ever read.
+CONFIG = ProfileRegistry("profiles")
 
 if not env.roles:
     env.roles = ['proxy', 'storage']
 
 
-# Generate a list of hosts from the environment if a list
-# was not provided as an argument.
-if not env.hosts:
-    env.hosts = hosts_by_prefix(env.host_prefix)
+# Work out every host's role, profile and zone from the profile's topology,
+# naming the hosts from the environment if a list was not provided as an
+# argument. Regardless of how we got here, the roledefs must be assigned.
+topology = load_topology()
+env.hosts = topology.hosts
+env.roledefs.update(topology.roles)
+
+
+# Cross-host coordination for the parallel tasks. These have to exist
+# before Fabric forks its workers.
+packaging_code = Event('packaging')
+packaged_code = Event('packaged code')
+packaging_failed = Event('packaging failed')
+config_ready = Event('proxy config and rings', env.roledefs['proxy'][:1])
+config_failed = Event('proxy config failed', env.roledefs['proxy'][:1])
+prep_auth_done = Event('auth prep', env.roledefs['proxy'][:1])
+tests_running = Event('tests')
+running_hosts = Barrier('swift restart', env.hosts)
+
+
+def restart_batches(size):
+    """The order of a rolling restart: storage hosts size at a time, then
+    the proxies one by one."""
+    storage = env.roledefs['storage']
+    batches = [storage[i:i + size] for i in xrange(0, len(storage), size)]
+    batches.extend([proxy] for proxy in env.roledefs['proxy'])
+    return batches
+
+
+# One barrier per batch of a rolling restart, which the hosts of the batch
+# arrive at once they are healthy again.
+healthy_batches = []
+if env.RESTART_MODE == "rolling":
+    healthy_batches = [Barrier('restart batch %d healthy' % (i + 1), batch)
+                       for i, batch in enumerate(
+                           restart_batches(env.RESTART_BATCH))]
+restart_batch = dict((host, i) for i, batch in enumerate(healthy_batches)
+                     for host in batch.hosts)
+restart_failed = Event('rolling restart')
+
+
+def sync_wait(primitive, message, failed=None):
+    """Waits for primitive, aborting after SWIFT_PHASE_TIMEOUT or as soon as
+    failed is set by whoever was meant to make it ready."""
+    if not primitive.ready():
+        log_info(message)
 
+    try:
+        if failed is None:
+            primitive.wait(env.PHASE_TIMEOUT)
+        else:
+            wait_any([primitive, failed], env.PHASE_TIMEOUT)
+    except SyncTimeout as e:
+        abort(red(str(e)))
 
-# Regardless of how we got here, the roledefs must be
-# assigned.
-roledefs_from_hosts()
+    if not primitive.ready():
+        abort(red("Giving up on %s, %s" % (primitive.name, failed.name)))
 
 
 def current_profile(host=None):
-    profile = env.PROFILE
-
-    # We need to be able to also pass this in for reimaging.
+    # We need to be able to also pass this in for reimaging. Hosts outside
+    # the cluster (eg. vmhosts) get the cluster's first profile.
     host = host or env.host
-
-    # If our profile environment setting isn't a comma-separated list,
-    # return it as its value every time.
-    #   eg: debian == debian,debian,debian,debian
-    if not ',' in profile:
-        return profile
-
-    return profile.split(',')[env.hosts.index(host)]
+    return topology.profile.get(host, env.PROFILE.split(',')[0])
 
 
 def config(key, host=None):
     return CONFIG[current_profile(host)][key]
 
 
+def config_get(key, default=None, host=None):
+    return CONFIG[current_profile(host)].get(key, default)
+
+
+scheduler = Scheduler(
+    env.hosts, [CONFIG[p] for p in set(topology.profile.values())],
+    dict((phase, env.get('parallel_%s' % phase))
+         for phase in ('ssh', 'vmhost', 'api', 'cluster')))
+if env.pool_size:
+    scheduler.limits['ssh'] = int(env.pool_size)
+
+
 def config_package_index(name, package_set="packages"):
     for idx, pkg in enumerate(config(package_set)):
         if pkg[0] == name:
@@ -200,24 +315,27 @@ def format_drives():
 
 
 def __format_drives_freebsd():
-    for zone, disk in enumerate(['ada'] * config("zone_count"), 1):
-        device = "{1}{0}".format(zone, disk)
-        run("zpool labelclear -f /dev/{device}".format(device=device))
-        run("zpool create -m /srv/node/disk{zone} {device} /dev/{device}"
-            .format(device=device, zone=zone))
+    with CommandBatch() as batch:
+        for zone, disk in enumerate(['ada'] * config("zone_count"), 1):
+            device = "{1}{0}".format(zone, disk)
+            batch.run("zpool labelclear -f /dev/{device}".format(
+                device=device))
+            batch.run("zpool create -m /srv/node/disk{zone} {device} "
+                      "/dev/{device}".format(device=device, zone=zone))
 
 
 def __format_drives_ubuntu():
     disks = run("ls -1 /dev/sd[b-z]").split()
-    for zone, disk in enumerate(disks, 1):
-        run("sgdisk -Z %s || true" % disk)
-        run("sgdisk --clear %s" % disk)
-        run("sgdisk -N 1 %s" % disk)  # default is linux data
-        run("mkfs.xfs -f %s1" % disk)
-        append("/etc/fstab", "%s1  /srv/node/disk%d  xfs "
-               "noatime  0 2" % (disk, zone))
-        run("mkdir -p /srv/node/disk%d" % zone)
-        run("mount /srv/node/disk%d" % zone)
+    with CommandBatch() as batch:
+        for zone, disk in enumerate(disks, 1):
+            batch.run("sgdisk -Z %s || true" % disk)
+            batch.run("sgdisk --clear %s" % disk)
+            batch.run("sgdisk -N 1 %s" % disk)  # default is linux data
+            batch.run("mkfs.xfs -f %s1" % disk)
+            batch.append("/etc/fstab", "%s1  /srv/node/disk%d  xfs "
+                         "noatime  0 2" % (disk, zone))
+            batch.run("mkdir -p /srv/node/disk%d" % zone)
+            batch.run("mount /srv/node/disk%d" % zone)
 
 
 def get_address(host, private=False):
@@ -231,27 +349,35 @@ def get_short_name(host):
 
 
 def current_role(role):
-    return env.host in env.roledefs[role]
+    return topology.role.get(env.host) == role
+
+
+def primary_proxy():
+    """The proxy that builds the rings and generates swift.conf. Any other
+    proxies install what it produced."""
+    return env.roledefs['proxy'][0]
 
 
 @task
-@parallel(5)
+@parallel(pool_size=scheduler.pool_size('ssh'))
 @with_settings(hide('stdout'))
 def cluster_prep(name=None):
-    run("hostname %s" % (env.host_string))
-    run("cp -f /usr/share/zoneinfo/America/Chicago /etc/localtime")
-    run("cp -f /etc/motd /etc/motd.bak")
-    run("echo '' > /etc/motd")
+    with CommandBatch() as batch:
+        batch.run("hostname %s" % (env.host_string))
+        batch.run("cp -f /usr/share/zoneinfo/America/Chicago /etc/localtime")
+        batch.run("cp -f /etc/motd /etc/motd.bak")
+        batch.run("echo '' > /etc/motd")
+
+    missing = rmissing(["/etc/rc.conf", "/etc/hostname", "/usr/local/bin/zsh"])
 
-    if rexists("/etc/rc.conf"):
+    if "/etc/rc.conf" not in missing:
         sed('/etc/rc.conf', '^hostname=.*$', 'hostname="%s"' %
             (env.host_string))
-    elif rexists("/etc/hostname"):
-        run("echo '' > /etc/hostname")
-        append("/etc/hostname", env.host_string)
+    elif "/etc/hostname" not in missing:
+        run("echo '%s' > /etc/hostname" % env.host_string)
 
     zshrc = "config/%s/.zshrc" % name
-    if exists(zshrc) and rexists("/usr/local/bin/zsh"):
+    if exists(zshrc) and "/usr/local/bin/zsh" not in missing:
         put(zshrc, "~")
         run("chsh -s /usr/local/bin/zsh")
 
@@ -279,26 +405,125 @@ def swift_package_set():
 @task
 @runs_once
 def swift_package():
-    if packaged_code.value == True:  # NOQA
+    if packaging_code.test_and_set():
+        sync_wait(packaged_code, "Waiting for code to be packaged...",
+                  packaging_failed)
         return
 
-    packaged_code.value = True
+    with failure_sets(packaging_failed):
+        __package_artifacts()
+    packaged_code.set()
+
+
+def __package_artifacts():
+    cache = ArtifactCache("tmp/cache", env.ARTIFACT_CACHE_MB * 1024 * 1024)
+    artifacts = []
 
     for package in swift_package_set():
         pkg, branch, url = package
+        patches = patches_for_package(pkg, branch)
+        revision = source_revision("work/%s" % pkg)
 
-        try:
-            rmtree("tmp/%s" % pkg)
-        except OSError:
-            print "No temp copy of %s found." % pkg
+        key = None
+        if revision:
+            key = artifact_key(package, revision, patches)
+
+        artifact = cache.lookup(key) if key else None
+        if artifact:
+            log_info("Reusing cached %s (%s)" % (pkg, key[:12]))
+            # tmp/<pkg> is what rsync deploys and local ring builds read,
+            # so it is unpacked again unless it is this very artifact.
+            if package_stamp(pkg) != key or not package_tree_intact(pkg):
+                unpack_artifact(pkg, artifact)
+        else:
+            artifact = build_artifact(pkg, patches,
+                                      cache.entry(key) if key else None)
+
+        write_package_stamp(pkg, key)
+        link_artifact(pkg, artifact)
+        artifacts.append(artifact)
+
+    for f in cache.evict(keep=artifacts):
+        log_info("Evicted cached artifact %s" % f)
+
+
+def build_artifact(pkg, patches, artifact=None):
+    try:
+        rmtree("tmp/%s" % pkg)
+    except OSError:
+        print "No temp copy of %s found." % pkg
+
+    copytree("work/%s" % pkg, "tmp/%s" % pkg,
+             ignore=ignore_patterns('.git', '.hg'))
+
+    for patch in patches:
+        local("patch -d tmp/{0} -p1 < {1}".format(pkg, patch))
+
+    artifact = artifact or "tmp/%s.tar.gz" % pkg
+    if islink("tmp/%s.tar.gz" % pkg):
+        remove("tmp/%s.tar.gz" % pkg)
+    # Written under another name first, so an interrupted tar never leaves
+    # a truncated archive where the cache would take it for a hit.
+    local("tar czf {1}.part -C tmp {0}".format(pkg, artifact))
+    rename(artifact + ".part", artifact)
+
+    return artifact
+
+
+def unpack_artifact(pkg, artifact):
+    try:
+        rmtree("tmp/%s" % pkg)
+    except OSError:
+        pass
+
+    local("tar xzf {0} -C tmp".format(artifact))
+
+
+def link_artifact(pkg, artifact):
+    tarball = "tmp/%s.tar.gz" % pkg
+    if abspath(tarball) == abspath(artifact):
+        return
+
+    if exists(tarball) or islink(tarball):
+        remove(tarball)
+    symlink(abspath(artifact), tarball)
 
-        copytree("work/%s" % pkg, "tmp/%s" % pkg,
-                 ignore=ignore_patterns('.git', '.hg'))
 
-        for patch in patches_for_package(pkg, branch):
-            local("patch -d tmp/{0} -p1 < {1}".format(pkg, patch))
+def package_stamp(pkg):
+    try:
+        return open("tmp/%s.key" % pkg).read().strip()
+    except IOError:
+        return None
 
-        local("cd tmp && tar czf {0}.tar.gz {0}".format(pkg))
+
+def package_tree_intact(pkg):
+    """True when tmp/<pkg> exists and nothing in it was added, removed or
+    changed since its stamp was written."""
+    try:
+        stamped = lstat("tmp/%s.key" % pkg).st_mtime
+    except OSError:
+        return False
+
+    if not exists("tmp/%s" % pkg):
+        return False
+
+    for root, dirs, files in walk("tmp/%s" % pkg):
+        if lstat(root).st_mtime > stamped:
+            return False
+        for name in files:
+            if lstat(join(root, name)).st_mtime > stamped:
+                return False
+    return True
+
+
+def write_package_stamp(pkg, key):
+    if not key:
+        if exists("tmp/%s.key" % pkg):
+            remove("tmp/%s.key" % pkg)
+        return
+
+    with open("tmp/%s.key" % pkg, "w") as f:
+        f.write(key)
 
 
 def patches_for_package(package, branch):
@@ -331,24 +556,215 @@ def swift_update_deps():
         local("cd %s && git pull; true" % repo)
 
 
+def wheel_builders():
+    builders = {}
+    for host in env.hosts:
+        builders.setdefault(current_profile(host), host)
+    return builders
+
+
+def wheelhouse_key():
+    stamps = [(pkg, package_stamp(pkg)) for pkg, _, _ in config("packages")]
+    key = {'packages': stamps,
+           'python_packages': config("python_packages"),
+           'swiftclient': SWIFTCLIENT_URL}
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def wheelhouse_archive(profile=None):
+    return "tmp/wheels/%s.tar.gz" % (profile or current_profile())
+
+
+def wheelhouse_stamp(profile=None):
+    return "tmp/wheels/%s.key" % (profile or current_profile())
+
+
+def wheelhouse_current():
+    """True when the profile's wheels were built from the packages as they
+    are now."""
+    try:
+        with open(wheelhouse_stamp()) as f:
+            stamp = f.read()
+    except IOError:
+        return False
+    return exists(wheelhouse_archive()) and stamp == wheelhouse_key()
+
+
+@task
+@parallel(pool_size=scheduler.pool_size('ssh'))
+@with_settings(hide('stdout'))
+def swift_wheels():
+    """Builds wheels for every package once per profile on the first host
+    using it and stores them locally in tmp/wheels/<profile>.tar.gz."""
+    check_swift_package_deps()
+    swift_package()
+
+    if wheel_builders()[current_profile()] != env.host:
+        return
+
+    if wheelhouse_current():
+        log_info("Wheels for %s are up to date" % current_profile())
+        return
+
+    src_dir = "/root/src"
+    run("rm -rf {0} {1} && mkdir -p {0} {1}".format(src_dir, WHEELHOUSE))
+    upgrade_pip()
+    run("pip install 'wheel<0.30'")
+
+    sources = []
+    for package in config("packages"):
+        pkg, branch, url = package
+        put("tmp/%s.tar.gz" % pkg, src_dir)
+        sources.append("%s/%s.tar.gz" % (src_dir, pkg))
+
+    sources.append("git+%s#egg=python-swiftclient" % SWIFTCLIENT_URL)
+    sources.extend("'%s'" % p for p in config("python_packages"))
+
+    run("pip wheel --wheel-dir={0} {1}".format(WHEELHOUSE, " ".join(sources)))
+    run("tar czf /root/wheelhouse.tar.gz -C /root wheelhouse")
+
+    if not exists("tmp/wheels"):
+        makedirs("tmp/wheels")
+    get("/root/wheelhouse.tar.gz", wheelhouse_archive())
+
+    with open(wheelhouse_stamp(), "w") as f:
+        f.write(wheelhouse_key())
+    log_success("Built wheelhouse for %s" % current_profile())
+
+
+def hosts_with_package(name):
+    return [h for h in env.hosts
+            if name in [pkg for pkg, _, _ in config("packages", h)]]
+
+
+def upload_artifact(local_path, remote_dir, hosts):
+    """Uploads an artifact directly, or with SWIFT_DISTRIBUTION=tree relays
+    it from host to host over the private network so the workstation only
+    sends it once. Returns the artifact's path on the host."""
+    if env.DISTRIBUTION != "tree":
+        remote_path = "%s/%s" % (remote_dir.rstrip('/'), basename(local_path))
+        put(local_path, remote_path)
+        return remote_path
+
+    return distribute(local_path, remote_dir, env.host, hosts,
+                      lambda host: get_address(host, private=True))
+
+
+def pip_version():
+    output = run("pip --version", pty=False)
+    return tuple(int(n) for n in re.findall(r'\d+', output.split()[1])[:2])
+
+
+def upgrade_pip():
+    """Upgrades pip and setuptools on the current host when its pip is too
+    old to build or install wheels."""
+    if pip_version() >= (1, 4):
+        return
+
+    log_info("Upgrading pip on %s for wheels" % env.host)
+    run("pip install --upgrade %s" % " ".join("'%s'" % r for r in WHEEL_PIP))
+    if pip_version() < (1, 4):
+        abort(red("pip on %s is still older than 1.4, cannot use wheels" %
+                  env.host))
+
+
+def install_wheelhouse():
+    if not exists(wheelhouse_archive()):
+        abort(red("No wheels for %s, please run 'fab swift_wheels' first." %
+                  current_profile()))
+
+    if env.host in wheelhouse_hosts:
+        return
+    wheelhouse_hosts.add(env.host)
+
+    archive = upload_artifact(wheelhouse_archive(), "/root",
+                              [h for h in env.hosts
+                               if current_profile(h) == current_profile()])
+    run("rm -rf {0} && tar xzf {1} -C /root".format(WHEELHOUSE, archive))
+    upgrade_pip()
+
+
+def pip_install_wheels(packages):
+    run("pip install --no-index --find-links={0} --no-deps "
+        "--force-reinstall {1}".format(WHEELHOUSE, " ".join(packages)))
+
+
 @with_settings(hide('stdout'))
 def swift_deploy_from_local(limit_packages=None):
+    """Installs the packaged code on the current host and returns the names
+    of the packages that were (re)installed."""
+    if env.DEPLOY_MODE == "wheel":
+        return __deploy_wheels(limit_packages)
+    elif env.DEPLOY_MODE == "rsync":
+        return __deploy_rsync(limit_packages)
+    else:
+        return __deploy_source(limit_packages)
+
+
+def selected_packages(limit_packages=None):
+    for package in config("packages"):
+        pkg, branch, url = package
+
+        if limit_packages:
+            if pkg not in limit_packages:
+                log_info("Skipping: %s" % pkg)
+                continue
+
+        yield package
+
+
+def __deploy_wheels(limit_packages=None):
+    packages = [pkg for pkg, _, _ in selected_packages(limit_packages)]
+    if not wheelhouse_current():
+        abort(red("The wheels for %s were built from older packages, please "
+                  "run 'fab swift_wheels' again." % current_profile()))
+    install_wheelhouse()
+    pip_install_wheels(packages)
+    return packages
+
+
+def __deploy_rsync(limit_packages=None):
+    src_dir = "/root/src"
+    run("mkdir -p %s" % src_dir)
+    installed = []
+
+    for package in selected_packages(limit_packages):
+        pkg, branch, url = package
+
+        changes = rsync_project("%s/%s" % (src_dir, pkg), "tmp/%s/" % pkg,
+                                exclude=RSYNC_EXCLUDES, delete=True,
+                                extra_opts="--itemize-changes",
+                                capture=True)
+        if not RSYNC_CHANGE.search(changes):
+            log_info("Unchanged: %s" % pkg)
+            continue
+
+        with settings(warn_only=True):
+            run("pip uninstall %s -y" % pkg)
+
+        with cd("%s/%s" % (src_dir, pkg)):
+            run("python setup.py build")
+            run("python setup.py install")
+
+        installed.append(pkg)
+
+    return installed
+
+
+def __deploy_source(limit_packages=None):
     src_dir = "/root/src"
     run("rm -rf {0} && mkdir -p {0}".format(src_dir))
+    installed = []
 
     with cd(src_dir):
-        for package in config("packages"):
+        for package in selected_packages(limit_packages):
             pkg, branch, url = package
 
-            if limit_packages:
-                if pkg not in limit_packages:
-                    log_info("Skipping: %s" % pkg)
-                    continue
-
             with settings(warn_only=True):
                 run("pip uninstall %s -y" % pkg)
 
-            put("tmp/%s.tar.gz" % pkg, src_dir)
+            upload_artifact("tmp/%s.tar.gz" % pkg, src_dir,
+                            hosts_with_package(pkg))
             run("rm -rf %s" % pkg)
             run("tar xvf %s.tar.gz" % pkg)
 
@@ -356,50 +772,116 @@ def swift_deploy_from_local(limit_packages=None):
                 run("python setup.py build")
                 run("python setup.py install")
 
+            installed.append(pkg)
+
+    return installed
+
 
 @task
-@parallel(5)
+@parallel(pool_size=scheduler.pool_size('ssh'))
 def refresh_code(*args):
     check_swift_package_deps()
     swift_package()
-    swift_deploy_from_local(args)
-    swift_restart()
+    swift_reload(packages=swift_deploy_from_local(args))
 
 
 @task
-@parallel(5)
+@parallel(pool_size=scheduler.pool_size('ssh'))
 def refresh_config(*args):
     check_swift_package_deps()
-    upload_proxy_config()
-    upload_storage_config()
-    swift_restart()
+    swift_reload(files=upload_proxy_config() + upload_storage_config())
 
 
 @task
-@parallel(5)
+@parallel(pool_size=scheduler.pool_size('cluster'))
 def rebuild_cluster():
     platform_init()
-    instance = platform.find_instance(env.host)
-
-    check_swift_package_deps()
-    swift_package()
-
-    reset_vm(instance)
-    wait_for_vm()
-
-    system_base()
-    python_base()
-    add_user()
-
-    swift_deploy_from_local()
-    swift_client()
-    swift_config_proxy()
-    swift_config_storage()
-    swift_restart()
-
-    prep_auth()
+    if env.host != primary_proxy():
+        rebuild_steps().run(env.PHASE_TIMEOUT)
+        return
 
-    swift_test(wait_for_prep=True)
+    # Everything the primary proxy does comes before config_ready, so any
+    # failure there releases the hosts waiting on its config and rings.
+    with failure_sets(config_failed):
+        rebuild_steps().run(env.PHASE_TIMEOUT)
+
+
+def rebuild_steps():
+    """The per-host steps of rebuild_cluster. Cross-host edges are the
+    events the proxy sets (config_ready, prep_auth_done) and the restart
+    barrier, so storage nodes format drives and install code while the
+    proxy is still being set up."""
+    state = {}
+
+    def find():
+        with scheduler.throttle('api'):
+            state['instance'] = platform.find_instance(env.host)
+
+    def package():
+        check_swift_package_deps()
+        swift_package()
+
+    def reset():
+        instance = state['instance']
+        # LVM snapshots and image downloads contend on the vmhost's disk,
+        # reloads on the SoftLayer API.
+        if hasattr(instance, 'vm_host'):
+            with scheduler.throttle('vmhost', instance.vm_host):
+                reset_vm(instance)
+        else:
+            with scheduler.throttle('api'):
+                reset_vm(instance)
+
+    steps = [
+        Step('find', find, cost=5),
+        Step('package', package, cost=30),
+        Step('reset', reset, ['find'], cost=300),
+        Step('wait_for_vm', wait_for_vm, ['reset'], cost=60),
+        Step('system_base', system_base, ['wait_for_vm'], cost=180),
+        # After package, whose stamps decide whether the wheels are current.
+        Step('python_base', python_base, ['system_base', 'package'],
+             cost=120),
+        Step('add_user', add_user, ['system_base'], cost=5),
+        Step('deploy', swift_deploy_from_local,
+             ['package', 'python_base', 'add_user'], cost=120),
+        Step('client', swift_client, ['deploy'], cost=60),
+    ]
+    configured = []
+
+    if env.host == primary_proxy():
+        steps.extend([
+            Step('rings', proxy_rings, ['package'], cost=20),
+            Step('proxy_prepare', proxy_prepare, ['add_user'], cost=20),
+            Step('proxy_rings', proxy_install_rings,
+                 ['rings', 'proxy_prepare'], cost=10),
+        ])
+        configured.append('proxy_rings')
+    elif current_role('proxy'):
+        # Other proxies share the primary's swift.conf and rings.
+        steps.extend([
+            Step('proxy_prepare', proxy_prepare, ['add_user'], [config_ready],
+                 cost=20),
+            Step('proxy_rings', install_rings, ['proxy_prepare'], cost=5),
+        ])
+        configured.append('proxy_rings')
+
+    if current_role('storage'):
+        steps.extend([
+            Step('storage_prepare', storage_prepare, ['add_user'], cost=60),
+            Step('storage_rings', install_rings, ['storage_prepare'],
+                 [config_ready], cost=5),
+        ])
+        configured.append('storage_rings')
+
+    steps.extend([
+        Step('restart', swift_restart, ['deploy', 'client'] + configured,
+             cost=20),
+        Step('prep_auth', prep_auth, ['restart'], cost=10),
+        Step('test', lambda: swift_test(wait_for_prep=True), ['prep_auth'],
+             cost=300),
+    ])
+
+    return StepGraph(steps, [config_failed])
 
 
 @serial
@@ -441,53 +923,157 @@ def reset_vm(instance):
 
 
 def wait_for_vm():
-    online = False
+    deadline = time() + env.BOOT_TIMEOUT
+    port = int(env.port or 22)
+
+    log_info("Waiting for VM to boot...")
+    if not wait_for_port(env.host, port, deadline):
+        abort(red("%s did not open port %d within %ds" %
+                  (env.host, port, env.BOOT_TIMEOUT)))
+
     with settings(hide('warnings', 'running', 'stdout', 'stderr'),
-                  warn_only=True):
-        while not online:
+                  warn_only=True, timeout=5, connection_attempts=1):
+        for delay in backoff():
             try:
                 run("echo")
                 log_success("VM is up!")
-                online = True
-            except:
-                log_info("Waiting for VM to boot...")
-                sleep(4)
+                return
+            except (NetworkError, SystemExit):
+                if time() + delay > deadline:
+                    abort(red("%s did not accept SSH within %ds" %
+                              (env.host, env.BOOT_TIMEOUT)))
+                log_info("Waiting for SSH on %s..." % env.host)
+                sleep(delay)
+
+
+@task
+@runs_once
+def wait_for_cluster():
+    """Waits for every host to answer on its SSH port, reporting each one
+    as it comes up."""
+    port = int(env.port or 22)
+    down = []
+
+    for host, secs in wait_for_hosts(env.hosts, port, env.BOOT_TIMEOUT):
+        if secs is None:
+            down.append(host)
+        else:
+            log_success("%s is up after %0.1f secs" % (host, secs))
+
+    if down:
+        abort(red("Hosts still down: %s" % ", ".join(down)))
+
+
+def package_proxy():
+    return env.PACKAGE_PROXY or config_get("package_proxy")
 
 
 def system_base():
     packages = config('system_packages')
-    with settings(hide('warnings', 'running', 'stdout', 'stderr')):
-        if current_profile() in ["ubuntu", "debian"]:
-            run("apt-get update")
+    manager = config("package_manager")
+    proxy = package_proxy()
+
+    # The cache is apt-cacher-ng, which refuses anything but Debian style
+    # archives, so other package managers fetch directly.
+    if proxy and not manager.startswith("apt-get"):
+        log_warn("The package cache only serves apt, %s fetches directly" %
+                 manager.split()[0])
+
+    with CommandBatch() as batch:
+        if manager.startswith("apt-get"):
+            if proxy:
+                batch.run("echo 'Acquire::http::Proxy \"{0}\";' > "
+                          "/etc/apt/apt.conf.d/01proxy".format(proxy))
+            batch.run("apt-get update")
 
-        for package in packages:
-            log_info("Installing: {0}".format(package))
-            run("{mgr} {pkg}; true".format(
-                mgr=config("package_manager"),
-                pkg=package))
+        log_info("Installing: {0}".format(" ".join(packages)))
+        batch.run("{mgr} {pkgs}".format(mgr=manager, pkgs=" ".join(packages)))
+
+
+@task
+@runs_once
+def package_cache(host):
+    """Installs apt-cacher-ng on host (eg. a vmhost) so nodes can fetch
+    packages through it by setting package_proxy in the profile or
+    SWIFT_PACKAGE_PROXY=http://<host>:3142. Only apt profiles use it."""
+    with settings(host_string=host):
+        run("apt-get install -y apt-cacher-ng")
+    log_success("Package cache available at http://%s:3142" % host)
+
+
+def installed_python_packages():
+    # pkg_resources takes a noticeable part of a second to import, so only
+    # the tasks that need it pay for it.
+    import pkg_resources
+
+    with settings(hide('running', 'stdout')):
+        frozen = run("pip freeze", pty=False)
+
+    installed = {}
+    for line in frozen.splitlines():
+        if '==' in line:
+            name, version = line.strip().split('==', 1)
+            installed[pkg_resources.safe_name(name).lower()] = version
+    return installed
+
+
+def missing_requirements(requirements, installed):
+    import pkg_resources
+
+    missing = []
+    for requirement in requirements:
+        req = pkg_resources.Requirement.parse(requirement)
+        version = installed.get(req.key)
+        if version is None or version not in req:
+            missing.append(requirement)
+    return missing
 
 
 @task
 def python_base():
-    packages = config("python_packages")
+    # Every host of the profile takes part in the wheelhouse upload, even
+    # one with nothing to install, or the hosts relaying from it wait on it.
+    # Stale wheels may lack the current python_packages, so those hosts all
+    # install from the index instead.
+    wheels = wheelhouse_current()
+    if exists(wheelhouse_archive()) and not wheels:
+        log_warn("Wheels for %s are out of date, installing from the index" %
+                 current_profile())
+    if wheels:
+        with settings(hide('warnings', 'running', 'stdout', 'stderr')):
+            install_wheelhouse()
+
+    packages = missing_requirements(config("python_packages"),
+                                    installed_python_packages())
+    if not packages:
+        log_info("Python packages already satisfied")
+        return
+
+    log_info("Installing: {0}".format(" ".join(packages)))
+    requirements = " ".join("'%s'" % p for p in packages)
+
     with settings(hide('warnings', 'running', 'stdout', 'stderr')):
-        for package in packages:
-            log_info("Installing: {0}".format(package))
-            run("pip install {0}; true".format(package))
+        if wheels:
+            run("pip install --no-index --find-links={0} {1}".format(
+                WHEELHOUSE, requirements))
+        else:
+            run("pip install {0}".format(requirements))
 
 
 def add_user():
     prefix = ''
+    batch = CommandBatch()
     if current_profile() == "freebsd":
         prefix = '/usr/local'
-        run("echo 'swift::::::Swift::/bin/sh:' | adduser -f - -w no")
+        batch.run("echo 'swift::::::Swift::/bin/sh:' | adduser -f - -w no")
     else:
-        run("adduser --system --no-create-home --shell /bin/sh "
-            "--disabled-password --group swift")
-    run("echo 'swift ALL=(ALL) ALL' >> {prefix}/etc/sudoers".format(
+        batch.run("adduser --system --no-create-home --shell /bin/sh "
+                  "--disabled-password --group swift")
+    batch.run("echo 'swift ALL=(ALL) ALL' >> {prefix}/etc/sudoers".format(
         prefix=prefix))
-    run("test -d /etc/swift || mkdir -p /etc/swift")
-    run("chown -R swift:swift /etc/swift")
+    batch.run("test -d /etc/swift || mkdir -p /etc/swift")
+    batch.run("chown -R swift:swift /etc/swift")
+    batch.execute()
 
 
 @task
@@ -510,21 +1096,26 @@ def init_logfiles():
     logfiles = ["all.log", "swift/proxy.log", "swift/proxy.error",
                 "swift/log_processor.log"]
 
-    # Create log directories all the way down to
-    # the hourly folder.
-    run("test -d /var/log/swift/hourly || mkdir -p /var/log/swift/hourly")
+    with CommandBatch() as batch:
+        # Create log directories all the way down to
+        # the hourly folder.
+        batch.run("test -d /var/log/swift/hourly || "
+                  "mkdir -p /var/log/swift/hourly")
 
-    # Finally touch and chmod all the log files
-    for logfile in logfiles:
-        run("touch /var/log/%s" % logfile)
-        run("chmod 600 /var/log/%s" % logfile)
+        # Finally touch and chmod all the log files
+        for logfile in logfiles:
+            batch.run("touch /var/log/%s" % logfile)
+            batch.run("chmod 600 /var/log/%s" % logfile)
 
 
-def swift_config_proxy():
-    if not current_role('proxy'):
-        return
-
+def proxy_rings():
     reset_local()
+
+    if ring_builder_available("tmp/swift"):
+        build_rings_local()
+
+
+def proxy_prepare():
     init_logfiles()
 
     upload_proxy_config()
@@ -536,51 +1127,78 @@ def swift_config_proxy():
     run("openssl req -new -x509 -nodes -batch -out /etc/swift/cert.crt "
         "-keyout /etc/swift/cert.key")
 
-    with cd("/etc/swift"):
-        run("swift-ring-builder account.builder create 12 2 1")
-        run("swift-ring-builder container.builder create 12 2 1")
-        run("swift-ring-builder object.builder create 12 2 1")
-
-        for node in env.roledefs['storage']:
-            for zone in xrange(1, config("zone_count"), 1):
-                conf = (zone, get_address(node, private=True), zone, 100)
 
-                run("swift-ring-builder account.builder "
-                    "add z{0}-{1}:6002/disk{2} {3}".format(*conf))
-                run("swift-ring-builder container.builder "
-                    "add z{0}-{1}:6001/disk{2} {3}".format(*conf))
-                run("swift-ring-builder object.builder "
-                    "add z{0}-{1}:6000/disk{2} {3}".format(*conf))
+def proxy_install_rings():
+    if ring_builder_available("tmp/swift"):
+        put("tmp/*.ring.gz", "/etc/swift")
+        put("tmp/builders/*.builder", "/etc/swift")
+        get("/etc/swift/swift.conf", "tmp")
+        config_ready.set()
+        log_success("Built rings locally and downloaded config from proxy")
+    else:
+        log_warn("Cannot import swift locally, building rings on the proxy")
+        __build_rings_remote()
+        get("/etc/swift/swift.conf", "tmp")
+        get("/etc/swift/*.ring.gz", "tmp")
+        config_ready.set()
+        log_success("Downloaded config and rings from proxy")
+
+
+def ring_devices():
+    devices = []
+    for node in env.roledefs['storage']:
+        for disk in xrange(1, config("zone_count", node), 1):
+            # Without zones in the topology every disk is its own zone.
+            devices.append({'zone': topology.zone.get(node, disk),
+                            'ip': get_address(node, private=True),
+                            'device': 'disk%d' % disk,
+                            'weight': 100})
+    return devices
+
+
+def build_rings_local():
+    changed = build_rings("tmp/swift", "tmp/builders", "tmp", ring_devices(),
+                          *RING_PARAMS)
+    for ring, rebalanced in sorted(changed.items()):
+        if rebalanced:
+            log_info("Rebalanced %s ring" % ring)
+
+
+def __build_rings_remote():
+    with cd("/etc/swift"):
+        for ring, _ in RING_PORTS:
+            run("swift-ring-builder {0}.builder create {1} {2} {3}".format(
+                ring, *RING_PARAMS))
 
-        run("swift-ring-builder account.builder rebalance")
-        run("swift-ring-builder container.builder rebalance")
-        run("swift-ring-builder object.builder rebalance")
+        for dev in ring_devices():
+            for ring, port in RING_PORTS:
+                run("swift-ring-builder {0}.builder add "
+                    "z{zone}-{ip}:{1}/{device} {weight}".format(
+                        ring, port, **dev))
 
-    get("/etc/swift/swift.conf", "tmp")
-    get("/etc/swift/*.ring.gz", "tmp")
-    log_success("Downloaded config and rings from proxy")
+        for ring, _ in RING_PORTS:
+            run("swift-ring-builder %s.builder rebalance" % ring)
 
 
-def swift_config_storage():
-    if not current_role('storage'):
-        return
-
+def storage_prepare():
     init_logfiles()
     format_drives()
 
-    run("mkdir -p /etc/swift/{object,container,account}")
-    run("mkdir -p /var/cache/swift")
-    run("mkdir -p /var/lock")
-    run("chmod o+x /var/cache")
-    run("chown -R swift:swift /srv/node /etc/swift /var/cache/swift")
-
-    # try and make /proc available in BSD
-    if current_profile() == 'freebsd':
-        run("mkdir -p /compat/linux/proc")
-        run("rmdir /proc ; ln -s /compat/linux/proc /proc")
-        append("/etc/fstab", "linprocfs /compat/linux/proc linprocfs rw 0 0",
-               escape=False)
-        append("/boot/loader.conf.local", "linprocfs_load=YES", escape=False)
+    with CommandBatch() as batch:
+        batch.run("mkdir -p /etc/swift/{object,container,account}")
+        batch.run("mkdir -p /var/cache/swift")
+        batch.run("mkdir -p /var/lock")
+        batch.run("chmod o+x /var/cache")
+        batch.run("chown -R swift:swift /srv/node /etc/swift "
+                  "/var/cache/swift")
+
+        # try and make /proc available in BSD
+        if current_profile() == 'freebsd':
+            batch.run("mkdir -p /compat/linux/proc")
+            batch.run("rmdir /proc ; ln -s /compat/linux/proc /proc")
+            batch.append("/etc/fstab",
+                         "linprocfs /compat/linux/proc linprocfs rw 0 0")
+            batch.append("/boot/loader.conf.local", "linprocfs_load=YES")
 
     upload_storage_config()
 
@@ -588,95 +1206,117 @@ def swift_config_storage():
         enable_service(svc)
         service(svc, action='restart')
 
-    # While the ring files and conf don't exist, wait.
-    while (not exists("tmp/swift.conf")
-            or not exists("tmp/account.ring.gz")
-            or not exists("tmp/container.ring.gz")
-            or not exists("tmp/object.ring.gz")):
-        log_info("Waiting for local config and ring files...")
-        sleep(5)
+
+def install_rings():
+    sync_wait(config_ready, "Waiting for local config and ring files...",
+              config_failed)
 
     put("tmp/swift.conf", "/etc/swift")
     put("tmp/*.ring.gz", "/etc/swift")
 
 
 def upload_storage_config():
+    """Brings the storage configs up to date and returns the paths that
+    changed, see ConfigBundle."""
     if not current_role('storage'):
-        return
+        return []
     address = get_address(env.host, private=True)
     host = get_short_name(env.host)
-    upload_template("config/account-server.conf",
-                    "/etc/swift/account-server.conf",
-                    {'private_address': address,
-                     'host_short': host}, backup=False)
-    upload_template("config/container-server.conf",
-                    "/etc/swift/container-server.conf",
-                    {'private_address': address,
-                     'host_short': host}, backup=False)
-    upload_template("config/object-server.conf",
-                    "/etc/swift/object-server.conf",
-                    {'private_address': address,
-                     'host_short': host}, backup=False)
     prefix = ''
     if current_profile() == 'freebsd':
         prefix = '/usr/local'
-    upload_template("config/rsyncd.conf", "{prefix}/etc/rsyncd.conf".format(
-        prefix=prefix), {'private_address': address}, backup=False)
-    upload_template("config/rsyslog.conf", "{prefix}/etc/rsyslog.conf".format(
-        prefix=prefix), backup=False)
+
+    bundle = ConfigBundle()
+    for server in ["account", "container", "object"]:
+        bundle.template("config/%s-server.conf" % server,
+                        "/etc/swift/%s-server.conf" % server,
+                        {'private_address': address,
+                         'host_short': host})
+    bundle.template("config/rsyncd.conf", "{prefix}/etc/rsyncd.conf".format(
+        prefix=prefix), {'private_address': address})
+    bundle.template("config/rsyslog.conf", "{prefix}/etc/rsyslog.conf".format(
+        prefix=prefix))
+    return bundle.sync()
+
+
+def hash_path_suffix(text):
+    for line in text.splitlines():
+        if line.startswith("swift_hash_path_suffix"):
+            return line.split("=", 1)[1].strip()
+    return None
+
+
+def local_hash_prefix():
+    """The hash path suffix of the swift.conf downloaded from the primary
+    proxy."""
+    with open("tmp/swift.conf") as f:
+        hash_prefix = hash_path_suffix(f.read())
+    if not hash_prefix:
+        abort(red("No swift_hash_path_suffix in tmp/swift.conf"))
+    return hash_prefix
 
 
 def upload_proxy_config():
+    """Brings the proxy configs up to date and returns the paths that
+    changed. Checking the host's copies also reads its swift.conf, so an
+    unchanged proxy costs one command."""
     if not current_role('proxy'):
-        return
+        return []
     address = get_address(env.host, private=True)
+    prefix = ''
+    if current_profile() == 'freebsd':
+        prefix = '/usr/local'
 
-    # Upload proxy configs
-
-    if not rexists("/etc/swift/swift.conf"):
+    configs = [("config/dispersion.conf", "/etc/swift/dispersion.conf"),
+               ("config/proxy-server.conf", "/etc/swift/proxy-server.conf"),
+               ("config/swift.conf", "/etc/swift/swift.conf"),
+               ("config/rsyslog.conf", "{prefix}/etc/rsyslog.conf".format(
+                   prefix=prefix))]
+    sums, contents = remote_files([path for _, path in configs],
+                                  read=["/etc/swift/swift.conf"])
+
+    if "/etc/swift/swift.conf" in contents:
+        hash_prefix = hash_path_suffix(contents["/etc/swift/swift.conf"])
+    elif env.host != primary_proxy():
+        sync_wait(config_ready, "Waiting for swift.conf from %s..." %
+                  primary_proxy(), config_failed)
+        hash_prefix = local_hash_prefix()
+    else:
         # Generate a secure secret server-side
         log_info("Not swift.conf found, generating ring!")
         hash_prefix = local("od -t x4 -N 8 -A n </dev/random"
                             "| sed -e 's/ //g'", capture=True)
-    else:
-        hash_prefix = run("grep swift_hash_path_suffix /etc/swift/swift.conf "
-                          "| sed -e 's/.*=[[:space:]]*//'")
 
     swift_sync_key = hash_prefix
     super_admin_key = hash_prefix
 
-    upload_template("config/dispersion.conf", "/etc/swift/dispersion.conf",
-                    {'private_address': address}, backup=False)
-    upload_template("config/proxy-server.conf", "/etc/swift/proxy-server.conf",
-                    {'private_address': address,
-                     'host': env.host,
-                     'swift_sync_key': swift_sync_key,
-                     'super_admin_key': super_admin_key,
-                     'host_prefix': env.host_prefix,
-                     'host_short': get_short_name(env.host)}, backup=False)
-    upload_template("config/swift.conf", "/etc/swift/swift.conf",
-                    {'hash_prefix': hash_prefix}, backup=False)
-    prefix = ''
-    if current_profile() == 'freebsd':
-        prefix = '/usr/local'
-    upload_template("config/rsyslog.conf", "{prefix}/etc/rsyslog.conf".format(
-        prefix=prefix), backup=False)
+    contexts = {
+        "config/dispersion.conf": {'private_address': address},
+        "config/proxy-server.conf": {'private_address': address,
+                                     'host': env.host,
+                                     'swift_sync_key': swift_sync_key,
+                                     'super_admin_key': super_admin_key,
+                                     'host_prefix': env.host_prefix,
+                                     'host_short': get_short_name(env.host)},
+        "config/swift.conf": {'hash_prefix': hash_prefix},
+    }
+
+    bundle = ConfigBundle()
+    for template, path in configs:
+        bundle.template(template, path, contexts.get(template))
+    return bundle.sync(sums)
 
 
 @task
 @runs_once
 def swift_test(wait_for_prep=False):
-    if tests_running.value == True:  # NOQA
+    if tests_running.test_and_set():
         return
 
-    tests_running.value = True
-
     if wait_for_prep:
-        while not all([running_hosts.value >= len(env.hosts),
-                       prep_auth_done.value == True]):  # NOQA
-            log_info("Waiting for all hosts to be available "
-                     "before testing...")
-            sleep(1)
+        message = "Waiting for all hosts to be available before testing..."
+        sync_wait(running_hosts, message)
+        sync_wait(prep_auth_done, message)
 
     if not env.TEST_CONFIG:
         abort(red("Please set your SWIFT_TEST_CONFIG_FILE environment "
@@ -687,38 +1327,149 @@ def swift_test(wait_for_prep=False):
 
 
 @task
-@parallel(5)
+@parallel(pool_size=scheduler.pool_size('cluster'))
 def swift_restart():
-    global running_hosts
-
-    while not rexists("/etc/swift/swift.conf"):
-        log_info("Still need swift.conf...")
-        sleep(2)
-    while not rexists("/etc/swift/account.ring.gz"):
-        log_info("Still need account.ring.gz...")
-        sleep(2)
-    while not rexists("/etc/swift/container.ring.gz"):
-        log_info("Still need container.ring.gz...")
-        sleep(2)
-    while not rexists("/etc/swift/object.ring.gz"):
-        log_info("Still need object.ring.gz...")
-        sleep(2)
+    """Restarts Swift on every host at once. With SWIFT_RESTART_MODE=rolling
+    it restarts SWIFT_RESTART_BATCH storage hosts at a time and then each
+    proxy, every batch waiting for the one before to answer again."""
+    log_info("Waiting for swift.conf and rings...")
+    missing = rwait_for(["/etc/swift/swift.conf",
+                         "/etc/swift/account.ring.gz",
+                         "/etc/swift/container.ring.gz",
+                         "/etc/swift/object.ring.gz"], env.PHASE_TIMEOUT)
+    if missing:
+        abort(red("Still missing on %s: %s" % (env.host, ", ".join(missing))))
+
+    if env.RESTART_MODE == "rolling":
+        rolling_restart()
+        return
 
     run("swift-init stop all; true")
     run("swift-init start all; true")
 
     log_success("Restarted!")
-    running_hosts.value += 1
+    running_hosts.arrive(env.host)
+
+    sync_wait(running_hosts, "%d/%d hosts running" %
+              (running_hosts.count(), len(running_hosts.hosts)))
+
+
+def health_urls():
+    if current_role('proxy'):
+        return ["http://127.0.0.1:80/healthcheck"]
+
+    address = get_address(env.host, private=True)
+    return ["http://%s:%d/recon/ringmd5" % (address, port)
+            for _, port in RING_PORTS]
 
-    while running_hosts.value < len(env.hosts):
-        log_info("%d/%d hosts running" % (running_hosts.value, len(env.hosts)))
-        sleep(1)
+
+def rolling_restart():
+    index = restart_batch[env.host]
+
+    if index:
+        previous = healthy_batches[index - 1]
+        if not previous.ready():
+            log_info("Waiting for restart batch %d of %d..." %
+                     (index, len(healthy_batches)))
+        try:
+            wait_any([previous, restart_failed], env.PHASE_TIMEOUT)
+        except SyncTimeout as e:
+            abort(red(str(e)))
+
+        if restart_failed.is_set():
+            abort(red("Not restarting %s, an earlier batch is unhealthy" %
+                      env.host))
+
+    run("swift-init stop all; true")
+    run("swift-init start all; true")
+
+    unhealthy = wait_until_healthy(health_urls(), env.HEALTH_TIMEOUT)
+    if unhealthy:
+        restart_failed.set()
+        abort(red("%s is not healthy after %ds: %s" %
+                  (env.host, env.HEALTH_TIMEOUT, ", ".join(unhealthy))))
+
+    log_success("Restarted and healthy!")
+    healthy_batches[index].arrive(env.host)
+    running_hosts.arrive(env.host)
+
+
+def host_swift_services():
+    if current_role('proxy'):
+        return ["proxy*"]
+    return ["account*", "container*", "object*"]
+
+
+def affected_services(files=(), packages=()):
+    """Returns the Swift servers (swift-init globs) and the system services
+    on the current host that use any of the changed files or packages."""
+    role_services = config("%s_services" % topology.role[env.host])
+    services = host_swift_services()
+    swift_services = []
+    system_services = []
+
+    # Anything we know nothing about affects every Swift server.
+    for path in files:
+        name = path.rsplit("/", 1)[-1]
+        if name in CONFIG_SYSTEM_SERVICES:
+            system_services.extend(
+                svc for svc in role_services
+                if svc.startswith(CONFIG_SYSTEM_SERVICES[name]))
+        elif CONFIG_SERVICES.get(name) is None:
+            swift_services.extend(services)
+        else:
+            swift_services.extend(CONFIG_SERVICES[name])
+
+    for pkg in packages:
+        if PACKAGE_SERVICES.get(pkg) is None:
+            swift_services.extend(services)
+        else:
+            swift_services.extend(PACKAGE_SERVICES[pkg])
+
+    return ([svc for svc in services if svc in swift_services],
+            sorted(set(system_services)))
+
+
+def swift_reload(files=(), packages=()):
+    """Gracefully reloads the Swift servers affected by the changed files
+    and packages (a reload lets running requests finish, and starts servers
+    that are down) and restarts affected system services. A host where
+    nothing changed is not touched."""
+    swift_services, system_services = affected_services(files, packages)
+    if not swift_services and not system_services:
+        log_info("Nothing changed, leaving services alone")
+        return
+
+    svc_cmd = config("service_manager")
+    batch = CommandBatch()
+    for svc in system_services:
+        batch.run(svc_cmd.format(service=svc, action='restart'))
+    # swift-init exits non-zero when a glob matches a server that is not
+    # configured on this host, which must not stop the remaining reloads.
+    for svc in swift_services:
+        batch.run("swift-init '%s' reload" % svc, warn_only=True)
+    batch.execute()
+
+    offset = len(system_services)
+    failed = []
+    for svc, status, output in zip(swift_services,
+                                   batch.statuses[offset:],
+                                   batch.outputs[offset:]):
+        if status:
+            failed.append(svc)
+            log_warn("swift-init '%s' reload failed on %s:\n%s" %
+                     (svc, env.host, output))
+
+    reloaded = [svc for svc in system_services + swift_services
+                if svc not in failed]
+    if reloaded:
+        log_success("Reloaded %s" % ", ".join(reloaded))
 
 
 @task
 @retry(5)
 def prep_auth():
-    if not current_role('proxy'):
+    if env.host != primary_proxy():
         return
 
     hash_prefix = run("grep super_admin_key /etc/swift/proxy-server.conf "
@@ -741,16 +1492,20 @@ def prep_auth():
         run("swauth-add-account -A http://{0}/auth/ -K {1} "
             "{2}".format(env.host, hash_prefix, account))
 
-    prep_auth_done.value = True
+    prep_auth_done.set()
 
 
 @task
 def swift_client():
+    if env.DEPLOY_MODE == "wheel":
+        install_wheelhouse()
+        pip_install_wheels(["python-swiftclient"])
+        return
+
     src_dir = "/root/src"
 
     with cd(src_dir):
-        run("git clone git://github.com/openstack/python-swiftclient.git "
-            "swift-client")
+        run("git clone %s swift-client" % SWIFTCLIENT_URL)
 
         with cd("swift-client"):
             with settings(warn_only=True):
@@ -1,5 +1,8 @@
-from fabric.api import execute, with_settings, settings, hide, run
+from os.path import dirname
+
+from fabric.api import execute, with_settings, settings, hide
 from fablib.logging import log_info
+from fablib.trace import run
 
 
 def execute_task_name(task_name, *args):
@@ -8,10 +11,60 @@ def execute_task_name(task_name, *args):
     return execute(t, *args)
 
 
-@with_settings(warn_only=True, runner=run)
-def rexists(name):
-    result = False
+def _paths(names):
+    if isinstance(names, basestring):
+        return [names]
+    return list(names)
+
+
+def _missing_script(paths):
+    return ("__missing=''; for __p in %s; do "
+            "ls -d $__p >/dev/null 2>&1 || __missing=\"$__missing $__p\"; "
+            "done" % " ".join("'%s'" % p for p in paths))
+
+
+@with_settings(warn_only=True)
+def rmissing(names):
+    """Returns which of names (paths or globs) do not exist on the remote
+    host, checking all of them with a single command."""
+    paths = _paths(names)
+    with settings(hide('stderr', 'stdout', 'running', 'warnings')):
+        result = run('%s; echo $__missing' % _missing_script(paths),
+                     pty=False)
+
+    if not result.succeeded:
+        return paths
+    return result.split()
+
+
+def rexists(names):
+    return not rmissing(names)
+
+
+@with_settings(warn_only=True)
+def rwait_for(names, timeout=600, interval=2):
+    """Blocks on the remote host until all of names exist or timeout
+    seconds pass, then returns the ones still missing. Uses inotifywait
+    to wake up on changes when the host has it."""
+    paths = _paths(names)
+    dirs = " ".join(sorted(set("'%s'" % dirname(p) for p in paths)))
+    script = ("__deadline=$(( $(date +%%s) + %(timeout)d )); "
+              "while :; do %(missing)s; "
+              "[ -z \"$__missing\" ] && break; "
+              "[ $(date +%%s) -ge $__deadline ] && break; "
+              "if command -v inotifywait >/dev/null 2>&1; then "
+              "inotifywait -qq -t %(interval)d -e create -e moved_to "
+              "-e close_write %(dirs)s 2>/dev/null; "
+              "[ $? -eq 1 ] && sleep %(interval)d; "
+              "else sleep %(interval)d; fi; "
+              "done; echo $__missing" % {'timeout': timeout,
+                                         'interval': interval,
+                                         'missing': _missing_script(paths),
+                                         'dirs': dirs})
+
     with settings(hide('stderr', 'stdout', 'running', 'warnings')):
-        result = runner('ls -l %s' % (name), pty=False)
+        result = run(script, pty=False)
 
-    return result and result.succeeded
+    if not result.succeeded:
+        return paths
+    return result.split()
@@ -0,0 +1,106 @@
+from fabric.api import env, settings, hide
+from fabric.utils import abort
+from fabric.colors import red
+
+from fablib.trace import run
+
+
+MARKER = '__BATCH_STEP__'
+
+
+class BatchError(Exception):
+    def __init__(self, index, command, status, output):
+        self.index = index
+        self.command = command
+        self.status = status
+        self.output = output
+        Exception.__init__(self, 'Step %d (%s) exited with status %s' %
+                           (index + 1, command, status))
+
+
+class CommandBatch(object):
+    """Collects shell commands and runs them on the current host as one
+    remote script. Every step reports its exit status, so a failure still
+    names the command that broke. Steps added with warn_only=True are
+    allowed to fail, like run(..., warn_only=True) or a trailing '; true'.
+
+        with CommandBatch() as batch:
+            batch.run("mkdir -p /var/cache/swift")
+            batch.run("chown -R swift:swift /var/cache/swift")
+    """
+
+    def __init__(self, abort_on_error=True):
+        self.abort_on_error = abort_on_error
+        self.commands = []
+        self.statuses = []
+        self.outputs = []
+
+    def run(self, command, warn_only=False):
+        self.commands.append((command, warn_only))
+
+    def append(self, path, text):
+        """Appends a line to path unless it is already present, the batched
+        counterpart of fabric.contrib.files.append."""
+        self.run("grep -qxF '{1}' {0} 2>/dev/null || echo '{1}' >> {0}"
+                 .format(path, text))
+
+    def script(self):
+        lines = []
+        for index, (command, warn_only) in enumerate(self.commands):
+            lines.append('{\n%s\n}' % command)
+            lines.append('__s=$?; echo; echo "%s %d $__s"' % (MARKER, index))
+            if not warn_only:
+                lines.append('[ $__s -eq 0 ] || exit $__s')
+        return '\n'.join(lines)
+
+    def parse(self, output):
+        self.statuses = []
+        self.outputs = []
+        current = []
+
+        for line in output.splitlines():
+            if line.startswith(MARKER):
+                self.statuses.append(int(line.split()[2]))
+                self.outputs.append('\n'.join(current).strip())
+                current = []
+            else:
+                current.append(line)
+
+        return '\n'.join(current).strip()
+
+    def failure(self, result):
+        for index, (command, warn_only) in enumerate(self.commands):
+            if index >= len(self.statuses):
+                return BatchError(index, command, result.return_code,
+                                  self.parse(result) or result.stderr)
+            if self.statuses[index] and not warn_only:
+                return BatchError(index, command, self.statuses[index],
+                                  self.outputs[index])
+        return None
+
+    def execute(self):
+        if not self.commands:
+            return []
+
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                      warn_only=True):
+            result = run(self.script(), pty=False)
+
+        self.parse(result)
+        error = self.failure(result) if result.failed else None
+        self.commands = []
+
+        if error and self.abort_on_error:
+            abort(red('%s on %s:\n%s' % (error, env.host_string,
+                                         error.output)))
+        elif error:
+            raise error
+
+        return self.statuses
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
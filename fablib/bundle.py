@@ -0,0 +1,103 @@
+import json
+import tarfile
+
+from collections import OrderedDict
+from hashlib import sha1
+from StringIO import StringIO
+from time import time
+
+from fabric.api import settings, hide
+
+from fablib.distribute import remote_python
+from fablib.trace import put, run
+
+
+BUNDLE_PATH = '/tmp/config-bundle.tar.gz'
+
+# Prints {"sums": {path: sha1 or null}, "contents": {path: text}} for the
+# paths given, with the contents of the ones prefixed with '+'. Python
+# rather than sha1sum, which FreeBSD does not have.
+REMOTE_FILES = """
+import hashlib, json, sys
+sums, contents = {}, {}
+for arg in sys.argv[1:]:
+    path = arg.lstrip('+')
+    try:
+        data = open(path, 'rb').read()
+    except IOError:
+        sums[path] = None
+        continue
+    sums[path] = hashlib.sha1(data).hexdigest()
+    if arg.startswith('+'):
+        contents[path] = data
+print json.dumps({'sums': sums, 'contents': contents})
+"""
+
+
+def remote_files(paths, read=()):
+    """Returns ({path: sha1 or None}, {path: contents}) for paths on the
+    current host in one command, with the contents of the paths in read."""
+    args = ['+' + p if p in read else p for p in paths]
+    args.extend('+' + p for p in read if p not in paths)
+
+    with settings(hide('running', 'stdout')):
+        result = remote_python(REMOTE_FILES, *args)
+
+    state = json.loads(result.splitlines()[-1])
+    return state['sums'], state['contents']
+
+
+class ConfigBundle(object):
+    """The config files of the current host, rendered locally the way
+    upload_template renders them. sync() compares them with the host's
+    copies and uploads only the files that differ, as one archive.
+
+        bundle = ConfigBundle()
+        bundle.template("config/rsyncd.conf", "/etc/rsyncd.conf",
+                        {'private_address': address})
+        changed = bundle.sync()
+    """
+
+    def __init__(self):
+        self.files = OrderedDict()
+
+    def template(self, filename, destination, context=None):
+        with open(filename) as f:
+            text = f.read()
+        if context:
+            text = text % context
+        self.files[destination] = text
+
+    def changed(self, sums):
+        return [path for path, text in self.files.items()
+                if sums.get(path) != sha1(text).hexdigest()]
+
+    def archive(self, paths):
+        data = StringIO()
+        tar = tarfile.open(fileobj=data, mode='w:gz')
+        for path in paths:
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(self.files[path])
+            info.mode = 0644
+            info.mtime = time()
+            tar.addfile(info, StringIO(self.files[path]))
+        tar.close()
+
+        data.seek(0)
+        return data
+
+    def sync(self, sums=None):
+        """Uploads the files that differ from the host's and returns their
+        paths. sums are the host's checksums if already known (see
+        remote_files()), otherwise they are fetched first."""
+        if sums is None:
+            sums, _ = remote_files(self.files.keys())
+
+        paths = self.changed(sums)
+        if not paths:
+            return []
+
+        with settings(hide('running', 'stdout')):
+            put(self.archive(paths), BUNDLE_PATH)
+            run("tar xzf {0} -C / && rm -f {0}".format(BUNDLE_PATH))
+        return paths
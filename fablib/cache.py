@@ -0,0 +1,103 @@
+import hashlib
+import json
+
+from os import listdir, makedirs, remove, utime
+from os.path import exists, getsize, getatime, join
+from subprocess import Popen, PIPE
+
+
+def _command_output(command, cwd):
+    try:
+        proc = Popen(command, cwd=cwd, stdout=PIPE, stderr=PIPE)
+    except OSError:
+        return ''
+    out, _ = proc.communicate()
+    return out if proc.returncode == 0 else ''
+
+
+def source_revision(path):
+    """Returns a string identifying the checked out revision of a work tree,
+    including a digest of any uncommitted changes and untracked files so a
+    dirty tree never matches a clean build."""
+    if exists(join(path, '.git')):
+        revision = _command_output(['git', 'rev-parse', 'HEAD'], path)
+        dirty = _command_output(['git', 'diff', 'HEAD'], path)
+        untracked = _command_output(['git', 'ls-files', '-o',
+                                     '--exclude-standard'], path)
+    elif exists(join(path, '.hg')):
+        revision = _command_output(['hg', 'id', '-i'], path)
+        dirty = _command_output(['hg', 'diff'], path)
+        untracked = _command_output(['hg', 'status', '-u', '-n'], path)
+    else:
+        return None
+
+    if not revision:
+        return None
+
+    digest = hashlib.sha1(dirty)
+    for name in sorted(untracked.splitlines()):
+        digest.update(name + '\0')
+        try:
+            digest.update(file_digest(join(path, name)))
+        except IOError:
+            pass
+
+    return '%s:%s' % (revision.strip(), digest.hexdigest())
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def artifact_key(package, revision, patches):
+    key = {'package': list(package),
+           'revision': revision,
+           'patches': [(p, file_digest(p)) for p in patches]}
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+class ArtifactCache(object):
+    """A directory of tarballs named by their content key. Entries are
+    touched on every hit and the least recently used ones are evicted once
+    the directory grows past max_bytes."""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+        if not exists(path):
+            makedirs(path)
+
+    def entry(self, key, suffix='.tar.gz'):
+        return join(self.path, key + suffix)
+
+    def lookup(self, key, suffix='.tar.gz'):
+        path = self.entry(key, suffix)
+        if not exists(path):
+            return None
+
+        utime(path, None)
+        return path
+
+    def entries(self):
+        return [join(self.path, f) for f in listdir(self.path)]
+
+    def evict(self, keep=()):
+        entries = sorted(self.entries(), key=getatime)
+        total = sum(getsize(f) for f in entries)
+        evicted = []
+
+        for f in entries:
+            if total <= self.max_bytes:
+                break
+            if f in keep:
+                continue
+            total -= getsize(f)
+            remove(f)
+            evicted.append(f)
+
+        return evicted
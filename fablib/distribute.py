@@ -0,0 +1,130 @@
+from os.path import basename
+from zlib import crc32
+
+from fabric.api import settings, hide
+from fabric.utils import abort
+from fabric.colors import red
+
+from fablib.cache import file_digest
+from fablib.logging import log_info, log_success
+from fablib.trace import put, run
+
+
+RELAY_BASE_PORT = 8700
+
+# Serves the one file at path as /<its name> and nothing else, exiting
+# once expected complete downloads have been sent or timeout passes.
+RELAY_SERVER = """
+import BaseHTTPServer, os, shutil, sys, time
+path, address, port, expected, timeout = sys.argv[1:6]
+name = '/' + os.path.basename(path)
+served = []
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+    def do_GET(self):
+        if self.path != name:
+            self.send_error(404)
+            return
+        f = open(path, 'rb')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(f.fileno())[6]))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+            self.wfile.flush()
+        except IOError:
+            return
+        finally:
+            f.close()
+        served.append(self.client_address)
+server = BaseHTTPServer.HTTPServer((address, int(port)), Handler)
+server.timeout = 1
+deadline = time.time() + float(timeout)
+while len(served) < int(expected) and time.time() < deadline:
+    server.handle_request()
+"""
+
+RELAY_FETCH = """
+import sys, time, urllib2
+url, path, timeout = sys.argv[1:4]
+deadline = time.time() + float(timeout)
+while True:
+    try:
+        data = urllib2.urlopen(url, timeout=30).read()
+        break
+    except Exception:
+        if time.time() > deadline:
+            sys.exit('Timed out fetching %s' % url)
+        time.sleep(1)
+open(path, 'wb').write(data)
+"""
+
+CHECKSUM = """
+import hashlib, sys
+digest = hashlib.sha1()
+f = open(sys.argv[1], 'rb')
+for chunk in iter(lambda: f.read(65536), ''):
+    digest.update(chunk)
+print digest.hexdigest()
+"""
+
+
+def remote_python(script, *args, **kwargs):
+    """Runs a python script on the remote host through a heredoc, so helpers
+    do not need to be uploaded first. Pass background=True to detach it."""
+    background = kwargs.pop('background', False)
+    command = "python - {0} <<'EOF'{1}\n{2}\nEOF".format(
+        " ".join("'%s'" % a for a in args),
+        " > /dev/null 2>&1 &" if background else "",
+        script.strip())
+    if background:
+        command = "nohup " + command
+    return run(command, pty=False, **kwargs)
+
+
+def tree_parent(index):
+    return (index - 1) // 2 if index else None
+
+
+def tree_children(index, count):
+    return [c for c in (2 * index + 1, 2 * index + 2) if c < count]
+
+
+def relay_port(name):
+    return RELAY_BASE_PORT + crc32(name) % 1000
+
+
+def distribute(local_path, remote_dir, host, hosts, address, timeout=600):
+    """Places local_path in remote_dir on host using a binary tree over
+    hosts: the first host receives it from the workstation and every other
+    host pulls it from its parent's relay on the private network. address
+    maps a host name to the address its relay binds to."""
+    name = basename(local_path)
+    remote_path = "%s/%s" % (remote_dir.rstrip('/'), name)
+    checksum = file_digest(local_path)
+    index = hosts.index(host)
+    parent = tree_parent(index)
+    port = relay_port(name)
+
+    with settings(hide('running', 'stdout')):
+        if parent is None:
+            put(local_path, remote_path)
+        else:
+            log_info("Fetching %s from %s" % (name, hosts[parent]))
+            url = "http://%s:%d/%s" % (address(hosts[parent]), port, name)
+            remote_python(RELAY_FETCH, url, remote_path, timeout)
+
+        remote_checksum = remote_python(CHECKSUM, remote_path).strip()
+        if remote_checksum != checksum:
+            abort(red("Checksum mismatch for %s on %s: %s != %s" %
+                      (name, host, remote_checksum, checksum)))
+
+        children = tree_children(index, len(hosts))
+        if children:
+            remote_python(RELAY_SERVER, remote_path, address(host), port,
+                          len(children), timeout, background=True)
+
+    log_success("Verified %s on %s" % (name, host))
+    return remote_path
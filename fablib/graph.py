@@ -0,0 +1,98 @@
+from fabric.colors import red
+from fabric.utils import abort
+
+from fablib.logging import log_info
+from fablib.sync import SyncTimeout, wait_any
+from fablib.trace import tracer
+
+
+class Step(object):
+    """One unit of work on the current host. requires names steps on the
+    same host that must finish first, waits_for holds fablib.sync events or
+    barriers set by other hosts, and cost is a rough duration in seconds
+    used to find the critical path."""
+
+    def __init__(self, name, func, requires=(), waits_for=(), cost=1):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.waits_for = list(waits_for)
+        self.cost = cost
+
+
+class StepGraph(object):
+    """Runs a DAG of steps for one host. Whenever more than one step is
+    ready, the one heading the longest remaining chain of work runs first.
+    When steps are only blocked on other hosts, the graph sleeps until any
+    of those events fires instead of polling, and aborts as soon as one of
+    failures (events other hosts set when their part broke) is set."""
+
+    def __init__(self, steps, failures=()):
+        self.steps = dict((s.name, s) for s in steps)
+        self.failures = list(failures)
+        self.order = [s.name for s in steps]
+        self.done = []
+
+        for step in steps:
+            for name in step.requires:
+                if name not in self.steps:
+                    raise ValueError('Step %s requires unknown step %s' %
+                                     (step.name, name))
+
+        self.priority = {}
+        for name in self.order:
+            self._priority(name, ())
+
+    def _priority(self, name, seen):
+        if name in self.priority:
+            return self.priority[name]
+        if name in seen:
+            raise ValueError('Steps %s form a cycle' %
+                             ' -> '.join(seen + (name,)))
+
+        dependents = [s.name for s in self.steps.values()
+                      if name in s.requires]
+        tail = max([self._priority(d, seen + (name,)) for d in dependents]
+                   or [0])
+        self.priority[name] = self.steps[name].cost + tail
+        return self.priority[name]
+
+    def _unblocked(self, step):
+        return all(r in self.done for r in step.requires)
+
+    def ready(self):
+        pending = [self.steps[n] for n in self.order if n not in self.done]
+        return [s for s in pending if self._unblocked(s) and
+                all(w.ready() for w in s.waits_for)]
+
+    def run(self, timeout=None):
+        while len(self.done) < len(self.order):
+            ready = self.ready()
+
+            if not ready:
+                blocking = []
+                for name in self.order:
+                    step = self.steps[name]
+                    if name in self.done or not self._unblocked(step):
+                        continue
+                    blocking.extend(w for w in step.waits_for
+                                    if not w.ready())
+                log_info('Waiting on %s...' %
+                         ', '.join(sorted(set(w.name for w in blocking))))
+                try:
+                    wait_any(blocking + self.failures, timeout)
+                except SyncTimeout as e:
+                    abort(red(str(e)))
+
+                failed = [f.name for f in self.failures if f.is_set()]
+                if failed and not self.ready():
+                    abort(red('Giving up, %s on another host' %
+                              ', '.join(failed)))
+                continue
+
+            step = max(ready, key=lambda s: (self.priority[s.name],
+                                             -self.order.index(s.name)))
+            log_info('Step: %s' % step.name)
+            with tracer.span(step.name, 'step'):
+                step.func()
+            self.done.append(step.name)
@@ -1,4 +1,5 @@
-from fabric.api import puts, green, yellow, red
+from fabric.api import puts
+from fabric.colors import green, yellow, red
 
 
 def log_success(*args):
@@ -0,0 +1,98 @@
+import socket
+
+from Queue import Queue, Empty
+from random import uniform
+from threading import Thread
+from time import time, sleep
+
+from fabric.api import settings, hide
+
+from fablib.distribute import remote_python
+
+
+def backoff(initial=0.25, maximum=8.0, factor=2.0):
+    """Yields exponentially growing delays capped at maximum, each with
+    random jitter so probes against many hosts do not line up."""
+    delay = initial
+    while True:
+        yield uniform(delay / 2, delay)
+        delay = min(delay * factor, maximum)
+
+
+def port_open(host, port, timeout=2.0):
+    try:
+        sock = socket.create_connection((host, port), timeout)
+    except (socket.error, socket.timeout):
+        return False
+
+    sock.close()
+    return True
+
+
+def wait_for_port(host, port, deadline, maximum=8.0):
+    """Waits until a TCP connect to host:port succeeds. Returns False if the
+    deadline (an absolute time) passes first."""
+    for delay in backoff(maximum=maximum):
+        timeout = min(2.0, max(deadline - time(), 0.1))
+        if port_open(host, port, timeout=timeout):
+            return True
+
+        remaining = deadline - time()
+        if remaining <= 0:
+            return False
+        sleep(min(delay, remaining))
+
+
+def wait_for_hosts(hosts, port, timeout):
+    """Probes all hosts concurrently and yields (host, seconds) as each one
+    starts answering on port. Hosts still down at the timeout are yielded
+    with None."""
+    started = time()
+    deadline = started + timeout
+    results = Queue()
+
+    def probe(host):
+        up = wait_for_port(host, port, deadline)
+        results.put((host, time() - started if up else None))
+
+    for host in hosts:
+        worker = Thread(target=probe, args=(host,))
+        worker.daemon = True
+        worker.start()
+
+    for _ in hosts:
+        try:
+            yield results.get(timeout=max(deadline - time(), 0) + 5)
+        except Empty:
+            return
+
+
+# Polls urls from the host itself until each answers 200, then prints the
+# ones that never did.
+HEALTHCHECK = """
+import sys, time, urllib2
+deadline = time.time() + float(sys.argv[1])
+pending = sys.argv[2:]
+while pending:
+    for url in list(pending):
+        try:
+            if urllib2.urlopen(url, timeout=5).getcode() == 200:
+                pending.remove(url)
+        except Exception:
+            pass
+    if not pending or time.time() > deadline:
+        break
+    time.sleep(1)
+print ' '.join(pending)
+"""
+
+
+def wait_until_healthy(urls, timeout):
+    """Waits on the current host until every url (eg. a healthcheck or
+    recon endpoint) answers, and returns the ones that did not within
+    timeout seconds. The polling runs on the host, in one command."""
+    with settings(hide('running', 'stdout'), warn_only=True):
+        result = remote_python(HEALTHCHECK, timeout, *urls)
+    if result.failed:
+        return list(urls)
+    return result.split()
@@ -0,0 +1,72 @@
+import json
+
+from os import listdir, stat
+from os.path import join
+
+
+REQUIRED_KEYS = ['platform', 'platform_options', 'package_manager',
+                 'service_manager', 'zone_count', 'system_packages',
+                 'python_packages', 'packages', 'proxy_services',
+                 'storage_services']
+
+
+class ProfileError(Exception):
+    pass
+
+
+class ProfileRegistry(object):
+    """The profiles in directory, read and validated the first time each is
+    asked for rather than all of them up front. A parsed profile is kept
+    with its file's mtime and read again once the file changes.
+
+        CONFIG = ProfileRegistry("profiles")
+        CONFIG["debian-6-libvirt"]["packages"]
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._cache = {}
+
+    def path(self, name):
+        return join(self.directory, '%s.json' % name)
+
+    def names(self):
+        return sorted(f[:-len('.json')] for f in listdir(self.directory)
+                      if f.endswith('.json'))
+
+    def load(self, name):
+        try:
+            with open(self.path(name)) as f:
+                profile = json.load(f)
+        except ValueError as e:
+            raise ProfileError('Profile %s is not valid JSON: %s' % (name, e))
+
+        missing = [key for key in REQUIRED_KEYS if key not in profile]
+        if missing:
+            raise ProfileError('Profile %s does not include %s' %
+                               (name, ', '.join(missing)))
+        return profile
+
+    def __getitem__(self, name):
+        try:
+            mtime = stat(self.path(name)).st_mtime
+        except OSError:
+            raise KeyError(name)
+
+        cached = self._cache.get(name)
+        if cached is None or cached[0] != mtime:
+            cached = self._cache[name] = (mtime, self.load(name))
+        return cached[1]
+
+    def __contains__(self, name):
+        try:
+            stat(self.path(name))
+        except OSError:
+            return False
+        return True
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
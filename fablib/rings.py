@@ -0,0 +1,132 @@
+import cPickle as pickle
+import sys
+
+from multiprocessing import Pool
+from os import makedirs, rename
+from os.path import abspath, exists, join
+
+
+RING_PORTS = (('account', 6002), ('container', 6001), ('object', 6000))
+
+
+def _import_builder(swift_path):
+    path = abspath(swift_path)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+    from swift.common.ring import RingBuilder
+    return RingBuilder
+
+
+def ring_builder_available(swift_path):
+    try:
+        _import_builder(swift_path)
+    except ImportError:
+        return False
+    return True
+
+
+def _load_builder(RingBuilder, path, part_power, replicas, min_part_hours):
+    if not exists(path):
+        return RingBuilder(part_power, replicas, min_part_hours)
+
+    with open(path, 'rb') as f:
+        builder = pickle.load(f)
+
+    # Like swift-ring-builder, accept both pickled builders and dicts.
+    if not hasattr(builder, 'devs'):
+        builder_dict = builder
+        builder = RingBuilder(1, 1, 1)
+        builder.copy_from(builder_dict)
+
+    return builder
+
+
+def _sync_devices(builder, devices):
+    """Adds, removes and reweighs devices so the builder matches devices.
+    A device whose zone changed is removed and added again, since a builder
+    cannot move a device between zones. Returns True when anything
+    changed."""
+    current = dict(((d['ip'], d['port'], d['device']), d)
+                   for d in builder.devs if d is not None)
+    wanted = dict(((d['ip'], d['port'], d['device']), d) for d in devices)
+    next_id = max([d['id'] for d in current.values()] or [-1]) + 1
+    changed = False
+
+    for key, dev in current.items():
+        if key not in wanted or dev['zone'] != wanted[key]['zone']:
+            builder.remove_dev(dev['id'])
+            del current[key]
+            changed = True
+        elif dev['weight'] != wanted[key]['weight']:
+            builder.set_dev_weight(dev['id'], wanted[key]['weight'])
+            changed = True
+
+    for key, dev in sorted(wanted.items()):
+        if key in current:
+            continue
+        dev = dict(dev, id=next_id, meta='')
+        builder.add_dev(dev)
+        next_id += 1
+        changed = True
+
+    return changed
+
+
+def build_ring(job):
+    """Creates or updates a single builder file and writes its ring. Runs in
+    a worker process, so job is a plain tuple."""
+    (swift_path, name, builder_path, ring_path, devices,
+     part_power, replicas, min_part_hours) = job
+    RingBuilder = _import_builder(swift_path)
+
+    builder_file = join(builder_path, '%s.builder' % name)
+    ring_file = join(ring_path, '%s.ring.gz' % name)
+
+    builder = _load_builder(RingBuilder, builder_file, part_power, replicas,
+                            min_part_hours)
+    changed = _sync_devices(builder, devices)
+
+    if changed:
+        if hasattr(builder, 'pretend_min_part_hours_passed'):
+            builder.pretend_min_part_hours_passed()
+        builder.rebalance()
+
+        data = builder.to_dict() if hasattr(builder, 'to_dict') else builder
+        with open(builder_file + '.tmp', 'wb') as f:
+            pickle.dump(data, f, protocol=2)
+        rename(builder_file + '.tmp', builder_file)
+
+    # Write through a temporary name, other hosts wait for the ring files.
+    builder.get_ring().save(ring_file + '.tmp')
+    rename(ring_file + '.tmp', ring_file)
+
+    return name, changed
+
+
+def build_rings(swift_path, builder_path, ring_path, devices, part_power=12,
+                replicas=2, min_part_hours=1):
+    """Builds the account, container and object rings for devices (dicts
+    with zone, ip, device and weight), one process per ring. Builder files
+    in builder_path are updated in place rather than recreated, and only
+    rebalanced when their devices changed. Returns {ring: changed}."""
+    if not exists(builder_path):
+        makedirs(builder_path)
+
+    jobs = []
+    for name, port in RING_PORTS:
+        ring_devices = [dict(d, port=port) for d in devices]
+        jobs.append((swift_path, name, builder_path, ring_path, ring_devices,
+                     part_power, replicas, min_part_hours))
+
+    try:
+        pool = Pool(len(jobs))
+    except AssertionError:
+        # Daemonic workers cannot fork, build the rings one by one.
+        return dict(build_ring(job) for job in jobs)
+
+    try:
+        return dict(pool.map(build_ring, jobs))
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,61 @@
+from contextlib import contextmanager
+from multiprocessing import BoundedSemaphore
+from zlib import crc32
+
+
+DEFAULT_PARALLELISM = {
+    # Work that only talks SSH to the hosts themselves.
+    'ssh': 50,
+    # Operations contending on one hypervisor's disk or network, per vmhost.
+    'vmhost': 2,
+    # Calls against the SoftLayer API, account wide.
+    'api': 4,
+}
+
+# Throttles keyed by resource (eg. vmhost name) spread over this many
+# semaphores. A collision only throttles two resources together.
+THROTTLE_BUCKETS = 32
+
+
+class Scheduler(object):
+    """Decides how many hosts each phase works on at once. Limits come from
+    DEFAULT_PARALLELISM, then the profiles' "parallelism" dicts (the lowest
+    wins when hosts use different profiles), then overrides, which are
+    usually the command line's --set parallel_<phase>=N.
+
+    Task width is applied with @parallel(pool_size=...). Shared resources
+    are protected inside tasks with throttle(), whose semaphores are made
+    here at import time so every forked worker shares them."""
+
+    def __init__(self, hosts, profiles, overrides=None):
+        self.hosts = list(hosts)
+        self.limits = dict(DEFAULT_PARALLELISM)
+        # Tasks that meet at a cluster-wide barrier deadlock unless every
+        # host runs at once, so they default to the whole cluster.
+        self.limits['cluster'] = len(self.hosts)
+
+        for phase in self.limits:
+            configured = [p['parallelism'][phase] for p in profiles
+                          if phase in p.get('parallelism', {})]
+            if configured:
+                self.limits[phase] = min(configured)
+
+        for phase, limit in (overrides or {}).items():
+            if limit:
+                self.limits[phase] = int(limit)
+
+        self._throttles = {}
+        for phase, limit in self.limits.items():
+            self._throttles[phase] = [BoundedSemaphore(max(limit, 1))
+                                      for _ in xrange(THROTTLE_BUCKETS)]
+
+    def pool_size(self, phase):
+        return max(1, min(len(self.hosts), self.limits[phase]))
+
+    @contextmanager
+    def throttle(self, phase, key=''):
+        buckets = self._throttles[phase]
+        semaphore = buckets[crc32(str(key)) % len(buckets)]
+
+        with semaphore:
+            yield
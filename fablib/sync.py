@@ -0,0 +1,135 @@
+from contextlib import contextmanager
+from multiprocessing import Array, Condition, Value
+from time import time
+
+
+# Every primitive shares one condition by default. They are created when
+# the fabfile is imported, before Fabric forks its parallel workers, so
+# each worker sees the same shared memory and is woken as soon as any of
+# them changes.
+_condition = Condition()
+
+
+class SyncTimeout(Exception):
+    def __init__(self, name, missing, timeout):
+        self.name = name
+        self.missing = missing
+        self.timeout = timeout
+        Exception.__init__(self, '%s not reached after %ds, waiting on: %s' %
+                           (name, timeout, ', '.join(missing) or 'unknown'))
+
+
+def _wait(condition, ready, timeout):
+    deadline = time() + timeout if timeout is not None else None
+
+    with condition:
+        while not ready():
+            if deadline is None:
+                condition.wait()
+                continue
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            condition.wait(remaining)
+
+    return True
+
+
+class Event(object):
+    """A flag shared by all workers. hosts names whoever is expected to set
+    it, so a timed out wait can say who it was waiting on."""
+
+    def __init__(self, name, hosts=(), condition=None):
+        self.name = name
+        self.hosts = list(hosts)
+        self._condition = condition or _condition
+        self._flag = Value('b', 0, lock=False)
+
+    def is_set(self):
+        return bool(self._flag.value)
+
+    ready = is_set
+
+    def missing(self):
+        return [] if self.is_set() else self.hosts
+
+    def set(self):
+        with self._condition:
+            self._flag.value = 1
+            self._condition.notify_all()
+
+    def clear(self):
+        with self._condition:
+            self._flag.value = 0
+
+    def test_and_set(self):
+        """Sets the flag and returns its previous value, atomically. Only
+        one worker ever sees False."""
+        with self._condition:
+            was_set = self.is_set()
+            self._flag.value = 1
+            self._condition.notify_all()
+        return was_set
+
+    def wait(self, timeout=None):
+        if not _wait(self._condition, self.is_set, timeout):
+            raise SyncTimeout(self.name, self.missing(), timeout)
+
+
+class Barrier(object):
+    """Tracks which of hosts have arrived. Arrivals are recorded per host,
+    so counts stay correct when hosts finish at the same moment and a
+    timed out wait lists the hosts that never showed up."""
+
+    def __init__(self, name, hosts, condition=None):
+        self.name = name
+        self.hosts = list(hosts)
+        self._index = dict((h, i) for i, h in enumerate(self.hosts))
+        self._condition = condition or _condition
+        self._arrived = Array('b', max(len(self.hosts), 1), lock=False)
+
+    def arrive(self, host):
+        with self._condition:
+            self._arrived[self._index[host]] = 1
+            self._condition.notify_all()
+
+    def count(self):
+        return sum(self._arrived[i] for i in xrange(len(self.hosts)))
+
+    def missing(self):
+        return [h for h in self.hosts if not self._arrived[self._index[h]]]
+
+    def ready(self):
+        return not self.missing()
+
+    def wait(self, timeout=None):
+        if not _wait(self._condition, self.ready, timeout):
+            raise SyncTimeout(self.name, self.missing(), timeout)
+
+
+def wait_any(primitives, timeout=None, condition=None):
+    """Blocks until at least one of primitives is ready. They must share
+    condition (the module's default one unless given)."""
+    primitives = list(primitives)
+
+    def ready():
+        return any(p.ready() for p in primitives)
+
+    if not _wait(condition or _condition, ready, timeout):
+        missing = []
+        for p in primitives:
+            missing.extend(h for h in p.missing() if h not in missing)
+        raise SyncTimeout(' or '.join(p.name for p in primitives), missing,
+                          timeout)
+
+
+@contextmanager
+def failure_sets(event):
+    """Sets event when the block raises or aborts, so the workers waiting
+    on its work can give up at once instead of timing out."""
+    try:
+        yield
+    except BaseException:
+        event.set()
+        raise
@@ -0,0 +1,78 @@
+ROLES = ('proxy', 'storage')
+
+# What a profile without a "topology" gets, the original four node cluster.
+DEFAULT_TOPOLOGY = {'proxy': 1, 'storage': 3}
+
+
+class TopologyError(Exception):
+    pass
+
+
+class Topology(object):
+    """Which role, profile and zone every host of the cluster has. It is
+    resolved once, so lookups are dict hits instead of scans of the host
+    list."""
+
+    def __init__(self, hosts, roles, profiles, zones=None):
+        self.hosts = list(hosts)
+        self.index = dict((host, i) for i, host in enumerate(self.hosts))
+        self.role = dict(roles)
+        self.roles = dict((role, [h for h in self.hosts
+                                  if self.role[h] == role])
+                          for role in ROLES)
+        self.profile = dict(profiles)
+        self.zone = dict(zones or {})
+
+
+def _role_spec(spec):
+    if isinstance(spec, dict):
+        return int(spec.get('count', 0)), spec.get('profile')
+    return int(spec), None
+
+
+def resolve_topology(prefix, profiles, topology=None, hosts=None):
+    """Builds the Topology of a cluster from a profile's "topology", eg.
+
+        "topology": {"proxy": 2,
+                     "storage": {"count": 48, "profile": "freebsd-libvirt"},
+                     "zones": 4,
+                     "domain": "stack.local"}
+
+    Hosts are named <prefix><n>.<domain>, proxies first. When hosts are
+    given (fab -H) they are used instead, the first ones being the proxies.
+    profiles lists SWIFT_CLUSTER_PROFILE: one name for every host, or one
+    per host, which overrides a role's profile. With "zones" storage hosts
+    are spread over that many zones, otherwise they get none."""
+    topology = topology or DEFAULT_TOPOLOGY
+    counts = {}
+    role_profiles = {}
+    for role in ROLES:
+        counts[role], role_profiles[role] = _role_spec(topology.get(role, 0))
+
+    if counts['proxy'] < 1:
+        raise TopologyError('A cluster needs at least one proxy')
+
+    if not hosts:
+        hosts = ['%s%d.%s' % (prefix, n, topology.get('domain', 'stack.local'))
+                 for n in xrange(1, sum(counts.values()) + 1)]
+
+    if len(profiles) > 1 and len(profiles) != len(hosts):
+        raise TopologyError('%d profiles given for %d hosts' %
+                            (len(profiles), len(hosts)))
+
+    roles = {}
+    host_profiles = {}
+    zones = {}
+    for i, host in enumerate(hosts):
+        role = 'proxy' if i < counts['proxy'] else 'storage'
+        roles[host] = role
+
+        if len(profiles) > 1:
+            host_profiles[host] = profiles[i]
+        else:
+            host_profiles[host] = role_profiles[role] or profiles[0]
+
+        if role == 'storage' and topology.get('zones'):
+            zones[host] = (i - counts['proxy']) % int(topology['zones']) + 1
+
+    return Topology(hosts, roles, host_profiles, zones)
@@ -0,0 +1,188 @@
+import atexit
+import errno
+import json
+
+from contextlib import contextmanager
+from functools import wraps
+from glob import glob
+from os import environ, getpid, makedirs, remove, rmdir
+from os.path import exists, getsize, join
+from time import strftime, time
+
+from fabric import api
+from fabric.contrib import files
+
+
+def _local_size(path):
+    if hasattr(path, 'getvalue'):
+        return len(path.getvalue())
+    return sum(getsize(p) for p in glob(path) if not p.endswith('/'))
+
+
+class Tracer(object):
+    """Records timed spans for remote and local operations and writes them
+    as a Chrome/Perfetto trace (chrome://tracing, ui.perfetto.dev).
+
+    Every process appends its spans to its own file as they finish, which
+    keeps recording cheap and works across the workers Fabric forks. When
+    the process that created the tracer exits, the files are merged into
+    tmp/trace/<run>.json and the slowest steps and the critical path are
+    printed."""
+
+    def __init__(self, directory='tmp/trace', enabled=True):
+        self.enabled = enabled
+        self.run_id = strftime('%Y%m%d-%H%M%S-') + str(getpid())
+        self.directory = join(directory, self.run_id)
+        self.path = self.directory + '.json'
+        self._owner = getpid()
+        self._pid = None
+        self._out = None
+
+        if enabled:
+            atexit.register(self.finish)
+
+    def _file(self):
+        if self._pid != getpid():
+            # Forked workers get here at the same time, so another one may
+            # have just created the directory.
+            try:
+                makedirs(self.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._pid = getpid()
+            self._out = open(join(self.directory, '%d.jsonl' % self._pid),
+                             'a', 1)
+        return self._out
+
+    def record(self, name, category, start, end, **args):
+        if not self.enabled:
+            return
+
+        args.setdefault('host', api.env.host_string or 'local')
+        args.setdefault('task', api.env.command or '')
+        self._file().write(json.dumps({'name': name,
+                                       'cat': category,
+                                       'ph': 'X',
+                                       'ts': int(start * 1e6),
+                                       'dur': int((end - start) * 1e6),
+                                       'tid': getpid(),
+                                       'args': args}) + '\n')
+
+    @contextmanager
+    def span(self, name, category, **args):
+        start = time()
+        try:
+            yield args
+        finally:
+            self.record(name, category, start, time(), **args)
+
+    def wrap(self, func, category, describe=None, measure=None):
+        """Traces every call to func. describe(*args, **kwargs) names the
+        span, and measure(result, *args, **kwargs) returns bytes moved."""
+        @wraps(func)
+        def traced(*args, **kwargs):
+            name = describe(*args, **kwargs) if describe else func.__name__
+            start = time()
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                extra = {}
+                if measure:
+                    try:
+                        extra['bytes'] = measure(result, *args, **kwargs)
+                    except (OSError, TypeError):
+                        pass
+                self.record(name, category, start, time(), **extra)
+        return traced
+
+    def wrap_methods(self, obj, names, category='platform'):
+        def label(name):
+            return lambda *a, **k: '%s.%s' % (category, name)
+
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is not None:
+                setattr(obj, name, self.wrap(method, category, label(name)))
+        return obj
+
+    def events(self):
+        events = []
+        for path in sorted(glob(join(self.directory, '*.jsonl'))):
+            with open(path) as f:
+                events.extend(json.loads(line) for line in f if line.strip())
+        return events
+
+    def finish(self, report=True):
+        if getpid() != self._owner or not exists(self.directory):
+            return
+
+        if self._out:
+            self._out.close()
+        events = self.events()
+
+        # One trace "process" per host, named after it.
+        hosts = sorted(set(e['args']['host'] for e in events))
+        pids = dict((h, i + 1) for i, h in enumerate(hosts))
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': pids[h],
+                  'args': {'name': h}} for h in hosts]
+        for e in events:
+            trace.append(dict(e, pid=pids[e['args']['host']]))
+
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+        for path in glob(join(self.directory, '*.jsonl')):
+            remove(path)
+        rmdir(self.directory)
+
+        if events and report:
+            api.puts(summary(events))
+            api.puts('Trace written to %s' % self.path)
+
+
+def critical_path(events):
+    """The host that finished last and its spans in order. With step spans
+    (fablib.graph) those are returned instead of individual commands."""
+    last = max(events, key=lambda e: e['ts'] + e['dur'])
+    host = last['args']['host']
+    spans = [e for e in events if e['args']['host'] == host]
+    steps = [e for e in spans if e['cat'] == 'step']
+    return host, sorted(steps or spans, key=lambda e: e['ts'])
+
+
+def summary(events, top=10):
+    lines = ['Slowest operations:']
+    for e in sorted(events, key=lambda e: -e['dur'])[:top]:
+        lines.append('  %8.3fs  %-24s %-10s %s' % (
+            e['dur'] / 1e6, e['args']['host'], e['cat'], e['name'][:60]))
+
+    host, path = critical_path(events)
+    start = min(e['ts'] for e in events)
+    end = max(e['ts'] + e['dur'] for e in events)
+    lines.append('Critical path (%s, %.3fs total):' %
+                 (host, (end - start) / 1e6))
+    for e in path:
+        lines.append('  %8.3fs  %-10s %s' % (e['dur'] / 1e6, e['cat'],
+                                             e['name'][:60]))
+    return '\n'.join(lines)
+
+
+tracer = Tracer(enabled=environ.get('SWIFT_TRACE', '1') != '0')
+
+run = tracer.wrap(api.run, 'run', lambda command, *a, **k: command)
+local = tracer.wrap(api.local, 'local', lambda command, *a, **k: command)
+put = tracer.wrap(
+    api.put, 'put',
+    lambda local_path=None, remote_path=None, *a, **k: 'put %s' % local_path,
+    lambda result, local_path=None, *a, **k: _local_size(local_path))
+get = tracer.wrap(
+    api.get, 'get',
+    lambda remote_path, *a, **k: 'get %s' % remote_path,
+    lambda result, *a, **k: sum(getsize(p) for p in result))
+upload_template = tracer.wrap(
+    files.upload_template, 'upload_template',
+    lambda filename, destination, *a, **k: 'upload %s' % destination,
+    lambda result, filename, *a, **k: getsize(filename))
@@ -1,3 +1,12 @@
+import fcntl
+import json
+
+from contextlib import contextmanager
+from os import makedirs, rename
+from os.path import dirname, exists
+from time import time
+
+
 class Instance(object):
     def __init__(self, name=None, id=None):
         self.id = id
@@ -7,7 +16,7 @@ class Instance(object):
 class Platform(object):
     def __init__(self, config, log_success, log_info, log_warn, log_error,
                  execute_handler=None, run_handler=None,
-                 host_broker_handler=None, rexists=None):
+                 host_broker_handler=None, rexists=None, rmissing=None):
         self._config = config
 
         self.log_success = log_success
@@ -18,6 +27,7 @@ class Platform(object):
         self.run_handler = run_handler
         self.host_broker_handler = host_broker_handler
         self.rexists = rexists
+        self.rmissing = rmissing
 
         if hasattr(self, '_on_init'):
             self._on_init()
@@ -42,3 +52,101 @@ class Platform(object):
 
     def instance_ready(self, instance):
         raise Exception("Method not implemented")
+
+
+@contextmanager
+def locked(path):
+    """Holds an exclusive lock on path (through path.lock) so parallel
+    workers can read and rewrite the JSON file at path one at a time."""
+    if dirname(path) and not exists(dirname(path)):
+        makedirs(dirname(path))
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    rename(path + '.tmp', path)
+
+
+class InventoryCache(object):
+    """A {key: record} index persisted as JSON so every parallel worker can
+    share one copy. The index is rebuilt with loader() once it is older than
+    ttl seconds, under a file lock so only one worker does the rebuilding
+    while the others wait and reuse its result. A key missing from an index
+    built less than miss_ttl seconds ago is taken to be absent rather than
+    rebuilding again."""
+
+    def __init__(self, path, ttl, loader, miss_ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self._loader = loader
+        self._data = None
+
+    def _locked(self):
+        return locked(self.path)
+
+    def _read(self):
+        return read_json(self.path)
+
+    def _write(self, data):
+        write_json(self.path, data)
+        self._data = data
+
+    def _fresh(self, data, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        return data is not None and time() - data['timestamp'] < ttl
+
+    def items(self):
+        if not self._fresh(self._data):
+            self._data = self._read()
+        if not self._fresh(self._data):
+            self.refresh()
+        return self._data['items']
+
+    def refresh(self):
+        """Rebuilds the index, unless another worker already did so since
+        this one last read it."""
+        seen = self._data['timestamp'] if self._data else None
+
+        with self._locked():
+            data = self._read()
+            if self._fresh(data) and data['timestamp'] != seen:
+                self._data = data
+                return
+
+            self._write({'timestamp': time(), 'items': self._loader()})
+
+    def get(self, key):
+        """Looks key up, rebuilding the index once if it is not there and
+        was not just built."""
+        record = self.items().get(key)
+        if record is None and not self._fresh(self._data, self.miss_ttl):
+            self.refresh()
+            record = self._data['items'].get(key)
+        return record
+
+    def update(self, key, record):
+        with self._locked():
+            data = self._read() or {'timestamp': time(), 'items': {}}
+            if record is None:
+                data['items'].pop(key, None)
+            else:
+                data['items'][key] = record
+            self._write(data)
@@ -0,0 +1,44 @@
+from core import Platform, Instance
+from time import sleep
+from zlib import crc32
+
+
+class SimulatedPlatform(Platform):
+    """A platform without machines behind it, used by benchmark.py. Every
+    host exists, is spread over vmhost_count pretend vmhosts, and platform
+    calls only take as long as api_secs (lookups) or reimage_secs."""
+
+    def _on_init(self):
+        self._vmhost_count = int(self.config('vmhost_count', 11))
+        self._api_secs = float(self.config('api_secs', 0.05))
+        self._reimage_secs = float(self.config('reimage_secs', 1.0))
+
+    def _instance(self, name):
+        id = crc32(name.lower()) & 0xffffffff
+        instance = Instance(id=id, name=name)
+        instance.vm_host = 'vmhost%02d' % (id % self._vmhost_count + 1)
+        return instance
+
+    def find_instance(self, name):
+        sleep(self._api_secs)
+        return self._instance(name)
+
+    def get_instance(self, id):
+        sleep(self._api_secs)
+        return Instance(id=id)
+
+    def create_instance(self, instance):
+        sleep(self._reimage_secs)
+        return self._instance(instance.name)
+
+    def reimage_instance(self, instance):
+        sleep(self._reimage_secs)
+
+    def reimage_instance_os(self, instance, disk=None):
+        sleep(self._reimage_secs)
+
+    def instance_ready(self, instance):
+        return True
+
+    def delete_instance(self, instance):
+        sleep(self._api_secs)
@@ -1,6 +1,8 @@
 from os import getenv
-from time import time, sleep
-from core import Platform, Instance
+from time import time
+from threading import Condition, Event, Thread
+from core import Platform, Instance, InventoryCache, locked, read_json, \
+    write_json
 from SoftLayer import Client
 from SoftLayer.CCI import CCIManager
 from paramiko import SSHClient
@@ -11,6 +13,192 @@ class _SuppressPolicy(object):
         pass
 
 
+INVENTORY_MASK = 'mask[id,fullyQualifiedDomainName]'
+
+
+def cci_inventory(manager):
+    """Lists the account's CCIs once, fetching only the fields the index
+    needs, keyed by lowercased FQDN."""
+    inventory = {}
+    for cci in manager.list_instances(mask=INVENTORY_MASK):
+        record = cci_record(cci)
+        inventory[record['fullyQualifiedDomainName'].lower()] = record
+    return inventory
+
+
+def cci_record(cci):
+    return {'id': cci.get('id'),
+            'fullyQualifiedDomainName': cci.get('fullyQualifiedDomainName',
+                                                '')}
+
+
+STATE_MASK = 'mask[id,fullyQualifiedDomainName,activeTransaction]'
+
+# Each phase resolves once its check is true of the instance's latest
+# state. A state of None means the instance is not listed on the account.
+STATE_CHECKS = {
+    'create': lambda c: c is not None and 'activeTransaction' not in c,
+    'reload_start': lambda c: c is not None and 'activeTransaction' in c,
+    'ready': lambda c: c is not None and 'activeTransaction' not in c,
+    'delete': lambda c: c is None,
+}
+
+
+class PendingState(object):
+    """Resolves when a watched instance reaches its phase. result() blocks
+    until then and returns the instance's state, and callbacks run on the
+    poller thread as soon as the transition is seen."""
+
+    def __init__(self, id, phase, callback=None):
+        self.id = id
+        self.phase = phase
+        self.started = time()
+        self.finished = None
+        self.state = None
+        self._callback = callback
+        self._done = Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def elapsed(self):
+        return (self.finished or time()) - self.started
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise Exception('Instance %s did not reach %s within %ss' %
+                            (self.id, self.phase, timeout))
+        return self.state
+
+    def _resolve(self, state):
+        self.state = state
+        self.finished = time()
+        self._done.set()
+        if self._callback:
+            self._callback(self)
+
+
+class SharedStates(object):
+    """The latest states of the instances every parallel worker is waiting
+    on, kept in a JSON file. A worker that finds them older than max_age
+    fetches them for all the workers with one call, under a file lock, and
+    the others reuse its result. An instance no worker has asked about for
+    expiry seconds is dropped."""
+
+    def __init__(self, path, max_age, expiry, fetch):
+        self.path = path
+        self.max_age = max_age
+        self.expiry = expiry
+        self._fetch = fetch
+
+    def get(self, ids):
+        now = time()
+        with locked(self.path):
+            data = read_json(self.path) or {'polled': 0, 'wanted': {},
+                                            'states': {}}
+            wanted = dict((id, seen) for id, seen in data['wanted'].items()
+                          if now - seen < self.expiry)
+            wanted.update((str(id), now) for id in ids)
+
+            if (now - data['polled'] >= self.max_age or
+                    any(str(id) not in data['states'] for id in ids)):
+                states = self._fetch([int(id) for id in wanted])
+                data['states'] = dict((id, states.get(int(id)))
+                                      for id in wanted)
+                data['polled'] = now
+
+            data['wanted'] = wanted
+            write_json(self.path, data)
+
+        return dict((id, data['states'][str(id)]) for id in ids)
+
+
+class CCIStatePoller(object):
+    """Tracks every instance being waited on and fetches all of their
+    states with one API call per tick. The tick is short while something is
+    expected to change soon (a reload starting, a delete) and long early in
+    an OS reload, tightening as the expected completion time approaches.
+
+    Each process has its own poller, so Fabric's parallel workers share
+    their states through the file at path when one is given."""
+
+    def __init__(self, client, expected_secs=600, short_secs=3,
+                 long_secs=30, path=None):
+        self._account = client['Account']
+        self.expected_secs = expected_secs
+        self.short_secs = short_secs
+        self.long_secs = long_secs
+        self._pending = []
+        self._condition = Condition()
+        self._thread = None
+        self._shared = None
+        if path:
+            self._shared = SharedStates(path, short_secs, 2 * long_secs,
+                                        self._fetch)
+
+    def watch(self, id, phase, callback=None):
+        pending = PendingState(id, phase, callback)
+        with self._condition:
+            self._pending.append(pending)
+            self._condition.notify()
+            if not self._thread or not self._thread.is_alive():
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return pending
+
+    def states(self, ids):
+        if self._shared:
+            return self._shared.get(set(ids))
+        return self._fetch(ids)
+
+    def _fetch(self, ids):
+        ids = sorted(set(ids))
+        guests = self._account.getVirtualGuests(
+            mask=STATE_MASK,
+            filter={'virtualGuests': {'id': {
+                'operation': 'in',
+                'options': [{'name': 'data', 'value': ids}]}}})
+        return dict((g['id'], g) for g in guests)
+
+    def interval(self):
+        interval = self.long_secs
+        for pending in self._pending:
+            if pending.phase in ('create', 'ready'):
+                remaining = self.expected_secs - pending.elapsed()
+                if remaining > self.long_secs:
+                    continue
+            interval = self.short_secs
+        return interval
+
+    def poll(self):
+        with self._condition:
+            pending = list(self._pending)
+        if not pending:
+            return
+
+        states = self.states([p.id for p in pending])
+        for p in pending:
+            state = states.get(p.id)
+            if STATE_CHECKS[p.phase](state):
+                with self._condition:
+                    self._pending.remove(p)
+                p._resolve(state)
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                # A failed API call only costs a tick, keep polling.
+                pass
+            with self._condition:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._condition.wait(self.interval())
+
+
 class CCIPlatform(Platform):
     _required_opts = ['cores', 'memory', 'domain',
                       'datacenter', 'os_code']
@@ -19,21 +207,31 @@ class CCIPlatform(Platform):
         self._client = Client(username=getenv('SL_USERNAME'),
                               api_key=getenv('SL_API_KEY'))
         self._manager = CCIManager(self._client)
+        self._poller = CCIStatePoller(
+            self._client, expected_secs=int(self.config('reload_secs', 600)),
+            path=self.config('states_path', 'tmp/softlayer-states.json'))
+        self._inventory = InventoryCache(
+            self.config('inventory_path', 'tmp/softlayer-inventory.json'),
+            int(self.config('inventory_ttl', 600)),
+            lambda: cci_inventory(self._manager),
+            int(self.config('inventory_miss_ttl', 60)))
 
     def find_instance(self, host_name):
-        instance = None
-        host_name = host_name.lower()
+        record = self._inventory.get(host_name.lower())
+        if not record:
+            return None
 
-        for ii in self._manager.list_instances():
-            fqdn = ii.get('fullyQualifiedDomainName', '')
-            if fqdn.lower() == host_name:
-                instance = Instance(id=ii.get('id'), name=fqdn)
-                break
+        return Instance(id=record['id'],
+                        name=record['fullyQualifiedDomainName'])
 
-        return instance
+    def _inventory_update(self, cci):
+        if cci and cci.get('fullyQualifiedDomainName'):
+            self._inventory.update(cci['fullyQualifiedDomainName'].lower(),
+                                   cci_record(cci))
 
     def get_instance(self, id):
         cci = self._manager.get_instance(id)
+        self._inventory_update(cci)
         return self._cci_to_instance(cci)
 
     def create_instance(self, host_name):
@@ -51,6 +249,7 @@ class CCIPlatform(Platform):
         print 'creating cci %s/%s' % (host_name, domain)
         print base_options
         cci = self._manager.create_instance(**base_options)
+        self._inventory_update(cci)
         cci = self._cci_await_ready(cci)
 
         self._cci_install_keys(cci['id'])
@@ -70,6 +269,7 @@ class CCIPlatform(Platform):
     def delete_instance(self, instance):
         self._manager.cancel_instance(instance.id)
         self._cci_await_delete(self._manager.get_instance(instance.id))
+        self._inventory.update(instance.name.lower(), None)
 
     def instance_ready(self, instance):
         cci = self._manager.get_instance(instance.id)
@@ -80,32 +280,22 @@ class CCIPlatform(Platform):
             return None
         return Instance(id=cci['id'], name=cci['fullyQualifiedDomainName'])
 
-    def _cci_await_state(self, cci, state_check, sleep_secs=5):
-        wait_start = time()
+    def _cci_await_state(self, cci, phase):
         self.log_info('Waiting for %s to change state...' % (cci['id']))
+        pending = self._poller.watch(cci['id'], phase)
+        state = pending.result()
 
-        while state_check(cci):
-            sleep(sleep_secs)
-            cci = self._manager.get_instance(cci['id'])
-            self.log_info('...')
-
-        self.log_info('Available after %0.3f secs.' % (time() - wait_start))
-        return cci
+        self.log_info('Available after %0.3f secs.' % pending.elapsed())
+        return state
 
     def _cci_await_ready(self, cci):
-        return self._cci_await_state(cci,
-                                     lambda c: 'activeTransaction' in c,
-                                     sleep_secs=5)
+        return self._cci_await_state(cci, 'ready')
 
     def _cci_await_transaction_start(self, cci):
-        return self._cci_await_state(cci,
-                                     lambda c: 'activeTransaction' not in c,
-                                     sleep_secs=2)
+        return self._cci_await_state(cci, 'reload_start')
 
     def _cci_await_delete(self, cci):
-        return self._cci_await_state(cci,
-                                     lambda c: c and 'id' in c,
-                                     sleep_secs=2)
+        return self._cci_await_state(cci, 'delete')
 
     def _get_cci_root_password(self, cci):
         passwords = self._manager.get_instance_passwords(cci['id'])
@@ -130,6 +320,9 @@ class CCIPlatform(Platform):
         if not keys_url:
             return
 
+        commands = ['mkdir -p ~/.ssh',
+                    'wget -T 10 -q -O ~/.ssh/authorized_keys %s' % keys_url]
+
         client_settings = {'hostname': cci['primaryIpAddress'],
                            'username': 'root',
                            'password': password}
@@ -137,7 +330,9 @@ class CCIPlatform(Platform):
         client.set_missing_host_key_policy(_SuppressPolicy())
         client.connect(look_for_keys=False, **client_settings)
 
-        client.exec_command('mkdir -p ~/.ssh')
-        client.exec_command('wget -T 10 -q -O ~/.ssh/authorized_keys %s' %
-                            keys_url)
+        # Waits for each command, so the keys are in place before the
+        # first Fabric connection tries them.
+        for command in commands:
+            _, stdout, _ = client.exec_command(command)
+            stdout.channel.recv_exit_status()
         client.close()
@@ -1,9 +1,9 @@
-from core import Platform, Instance
+from core import Platform, Instance, InventoryCache
 import libvirt
-from lxml import etree
 from StringIO import StringIO
 from os.path import basename
 from time import sleep
+from threading import Lock, Thread
 
 
 class LibVirtPlatform(Platform):
@@ -12,61 +12,133 @@ class LibVirtPlatform(Platform):
 
     def _on_init(self):
         self._conn = None
+        self._conns = {}
+        self._conns_lock = Lock()
         self._vmhosts = [self.config('vmhost_pattern') % x for x in
                          range(1, int(self.config('vmhost_count')) + 1)]
+        self._inventory = InventoryCache(
+            self.config('inventory_path', 'tmp/libvirt-inventory.json'),
+            int(self.config('inventory_ttl', 600)),
+            self._build_inventory,
+            int(self.config('inventory_miss_ttl', 60)))
+
+    def _alive(self, conn):
+        try:
+            return conn is not None and conn.isAlive()
+        except libvirt.libvirtError:
+            return False
+
+    def _connection(self, vm_host):
+        with self._conns_lock:
+            conn = self._conns.get(vm_host)
+        if self._alive(conn):
+            return conn
+
+        # Opened without the lock, so handshakes with different vmhosts
+        # happen at the same time.
+        conn = libvirt.open('qemu+ssh://root@%s/system' % vm_host)
+        with self._conns_lock:
+            current = self._conns.get(vm_host)
+            if self._alive(current):
+                conn.close()
+                return current
+            self._conns[vm_host] = conn
+        return conn
+
+    def _domain_xml(self, dom):
+        # Only needed when the inventory is rebuilt, which a fresh cache
+        # skips, so lxml is not imported with the platform.
+        from lxml import etree
+
+        domxml = None
+        while not domxml:
+            try:
+                domxml = etree.parse(
+                    StringIO(
+                        dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE |
+                                    libvirt.VIR_DOMAIN_XML_SECURE)))
+            except libvirt.libvirtError:
+                self.log_error('Whoops, race issues on libvirt, '
+                               'retrying')
+                sleep(1)
+        return domxml
+
+    def _vmhost_domains(self, vm_host):
+        self.log_info("Indexing domains on %s" % vm_host)
+        conn = self._connection(vm_host)
+        doms = []
+
+        for dm in conn.listDomainsID():
+            try:
+                doms.append(conn.lookupByID(dm))
+            except libvirt.libvirtError:
+                pass
+        doms.extend(
+            [conn.lookupByName(dm) for dm in conn.listDefinedDomains()])
+
+        records = {}
+        for dom in doms:
+            domxml = self._domain_xml(dom)
+            vm_name = domxml.xpath('//name/text()')[0]
+            records[vm_name.lower()] = {
+                'name': vm_name,
+                'vm_host': vm_host,
+                'disk_names': domxml.xpath(
+                    "//disk[@type='block']/source/@dev")}
+        return records
+
+    def _build_inventory(self):
+        """Indexes the domains of every vmhost, querying them all at once."""
+        results = {}
+        errors = {}
+
+        def index(vm_host):
+            try:
+                results[vm_host] = self._vmhost_domains(vm_host)
+            except libvirt.libvirtError as e:
+                errors[vm_host] = e
+
+        workers = [Thread(target=index, args=(vm_host,))
+                   for vm_host in self._vmhosts]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for vm_host, e in sorted(errors.items()):
+            self.log_error("Cannot index %s: %s" % (vm_host, e))
+
+        inventory = {}
+        # Keep the first vmhost's domain when a name is defined twice, as
+        # the sequential scan used to.
+        for vm_host in reversed(self._vmhosts):
+            inventory.update(results.get(vm_host, {}))
+        return inventory
 
     def find_instance(self, host_name):
-        instance = None
-        vm_host = None
-        domain = None
-        disk_names = None
         short_name = host_name.split('.')[0]
 
-        for vm_host in self._vmhosts:
-            self.log_info("Looking for %s on %s" % (short_name, vm_host))
-            conn = libvirt.open('qemu+ssh://root@%s/system' % vm_host)
-            doms = []
-
-            for dm in conn.listDomainsID():
-                try:
-                    doms.append(conn.lookupByID(dm))
-                except libvirt.libvirtError:
-                    pass
-            doms.extend(
-                [conn.lookupByName(dm) for dm in conn.listDefinedDomains()])
-
-            for dom in doms:
-                domxml = None
-                while not domxml:
-                    try:
-                        domxml = etree.parse(
-                            StringIO(
-                                dom.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE |
-                                            libvirt.VIR_DOMAIN_XML_SECURE)))
-                    except libvirt.libvirtError:
-                        self.log_error('Whoops, race issues on libvirt, '
-                                       'retrying')
-                        sleep(1)
-
-                vm_name = domxml.xpath('//name/text()')[0]
-
-                if short_name.lower() != vm_name.lower():
-                    continue
-
-                self.log_success("Found %s(%s) on %s" % (vm_name, short_name,
-                                                         vm_host))
-                disk_names = domxml.xpath("//disk[@type='block']/source/@dev")
-                domain = dom
-                break
-
-            conn.close()
+        for attempt in range(2):
+            record = self._inventory.get(short_name.lower())
+            if not record:
+                return None
 
-            if domain:
-                instance = Instance(id=short_name, name=host_name)
-                instance.vm_host = vm_host
-                instance.domain = domain
-                instance.disk_names = disk_names
+            try:
+                domain = self._connection(record['vm_host']).lookupByName(
+                    record['name'])
                 break
+            except libvirt.libvirtError:
+                # The domain moved or went away since the index was built.
+                self._inventory.refresh()
+        else:
+            return None
+
+        self.log_success("Found %s(%s) on %s" % (record['name'], short_name,
+                                                 record['vm_host']))
+        instance = Instance(id=short_name, name=host_name)
+        instance.vm_host = record['vm_host']
+        instance.domain = domain
+        instance.disk_names = record['disk_names']
 
         return instance
 
@@ -102,11 +174,14 @@ class LibVirtPlatform(Platform):
             'base': base_img,
             'url': self.config('base_image_url')}
 
-        if self.rexists(disk):
+        base_disk = '/dev/sheepdog/%s' % base_img
+        missing = self.rmissing([disk, base_disk])
+
+        if disk not in missing:
             self.log_info("Deleting %s" % disk)
             self.run_handler("lvremove -f %s" % disk)
 
-        if not self.rexists('/dev/sheepdog/%s' % base_img):
+        if base_disk in missing:
             self.log_info("Downloading %s base template" % base_img)
             self.run_handler("lvcreate -L4G -n %s sheepdog" % base_img)
             self.run_handler("wget -q -O - %(url)s.raw.xz |"
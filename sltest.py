@@ -1,20 +1,35 @@
 #!/usr/bin/env python
-from sys import stdout
+from argparse import ArgumentParser
 from os import getenv
-from time import time, sleep
+from Queue import Queue
+from time import time
 from SoftLayer import Client
 from SoftLayer.CCI import CCIManager
 
+from platforms.core import InventoryCache
+from platforms.softlayer import CCIStatePoller, cci_inventory
+
 
 cluster = 'swift-dev'
-host_format = '%s%d.stack.local'
+domain = 'stack.local'
 host_count = 4
-hosts = [host_format % (cluster, x) for x in range(1, host_count + 1)]
+cci_options = {'cpus': 2,
+               'memory': 2048,
+               'datacenter': 'sjc01',
+               'os_code': 'DEBIAN_6_64'}
 
-# Uses SoftLayer CCI Manager to provision 4 swift dev machines
+# Uses SoftLayer CCI Manager to provision swift dev machines
 client = Client(username=getenv('SL_USERNAME'), api_key=getenv('SL_API_KEY'))
 ccis = CCIManager(client)
-instances = []
+poller = CCIStatePoller(client)
+# New hosts are all missing from the first listing, which they then share
+# instead of listing the account again for every one of them.
+instances = InventoryCache('tmp/softlayer-inventory.json', 600,
+                           lambda: cci_inventory(ccis), miss_ttl=60)
+
+
+def cluster_hosts(cluster, domain, count):
+    return ['%s%d.%s' % (cluster, x, domain) for x in range(1, count + 1)]
 
 
 def is_proxy(host):
@@ -23,16 +38,9 @@ def is_proxy(host):
 
 
 def get_cci(host):
-    global instances
-    if not instances:
-        instances = ccis.list_instances()
-
-    instance = None
-    for ii in instances:
-        if ii.get('fullyQualifiedDomainName', '') == host:
-            instance = ii
-            print 'found %s as cci %d' % (host, ii.get('id'))
-            break
+    instance = instances.get(host.lower())
+    if instance:
+        print 'found %s as cci %d' % (host, instance['id'])
 
     return instance
 
@@ -43,12 +51,7 @@ def create_cci(host, proxy=False):
     type = 'proxy' if proxy else 'storage'
     print 'creating cci %s node %s/%s' % (type, hostname, domain)
 
-    base_options = {'cpus': 2,
-                    'memory': 2048,
-                    'hostname': hostname,
-                    'domain': domain,
-                    'datacenter': 'sjc01',
-                    'os_code': 'DEBIAN_6_64'}
+    base_options = dict(cci_options, hostname=hostname, domain=domain)
     print base_options
     return ccis.create_instance(**base_options)
 
@@ -71,39 +74,22 @@ def reimage_cci(instance=None):
     return ccis.reload_instance(instance['id'])
 
 
-def cci_ready(instance):
-    return 'activeTransaction' not in instance
-
-
 def wait_for_reload_start(instance):
-    wait_start = time()
-    stdout.write('Waiting for reload to start on %s...' %
-                 instance['fullyQualifiedDomainName'])
-    stdout.flush()
-
-    while cci_ready(instance):
-        sleep(1)
-        instance = ccis.get_instance(instance['id'])
-        stdout.write('.')
-        stdout.flush()
-
-    print 'began after %0.3f secs.' % (time() - wait_start)
+    print 'Waiting for reload to start on %s...' % \
+        instance['fullyQualifiedDomainName']
+    pending = poller.watch(instance['id'], 'reload_start')
+    instance = pending.result()
+
+    print 'began after %0.3f secs.' % pending.elapsed()
     return instance
 
 
 def wait_for_cci(instance):
-    wait_start = time()
-    stdout.write('Waiting for %s...' %
-                 instance['fullyQualifiedDomainName'])
-    stdout.flush()
-
-    while not cci_ready(instance):
-        sleep(3)
-        instance = ccis.get_instance(instance['id'])
-        stdout.write('.')
-        stdout.flush()
-
-    print 'available after %0.3f secs.' % (time() - wait_start)
+    print 'Waiting for %s...' % instance['fullyQualifiedDomainName']
+    pending = poller.watch(instance['id'], 'ready')
+    instance = pending.result()
+
+    print 'available after %0.3f secs.' % pending.elapsed()
     return instance
 
 
@@ -118,21 +104,93 @@ def destroy_vm(host):
     print 'result: %s' % reimage_result
 
 
-if __name__ == '__main__':
+def root_password(instance):
+    passwords = dict(get_cci_passwords(instance))
+    return passwords.get('root')
+
+
+def start_provisioning(host):
+    """Creates or reloads the CCI for host without waiting on it."""
+    cci = get_cci(host)
+    print 'Host: %s (instance %s)' % (host, cci['id'] if cci else None)
+
+    if cci:
+        reimage_cci(cci)
+    else:
+        cci = create_cci(host, proxy=is_proxy(host))
+
+    return cci
+
+
+def provision_serial(hosts):
+    for host in hosts:
+        started = time()
+        cci = start_provisioning(host)
+        cci = wait_for_reload_start(cci)
+        cci = wait_for_cci(cci)
+
+        print '%s ready after %0.3f secs, password: root/%s' % (
+            host, time() - started, root_password(cci))
+
+
+def provision_concurrent(hosts):
+    """Issues every create/reload call up front, then waits on all hosts
+    through one poller, reporting each host as soon as it is ready."""
+    started = time()
+    finished = Queue()
+
+    def reloading(host):
+        def callback(pending):
+            print '%s: reload began after %0.3f secs' % (
+                host, time() - started)
+            poller.watch(pending.id, 'ready', ready(host))
+        return callback
+
+    def ready(host):
+        def callback(pending):
+            try:
+                password = root_password(pending.state)
+            except Exception as e:
+                password = '<unavailable: %s>' % e
+            print '%s: ready after %0.3f secs, password: root/%s' % (
+                host, time() - started, password)
+            finished.put(host)
+        return callback
+
     for host in hosts:
-        cci = get_cci(host)
-        id = cci['id'] if cci else None
-
-        print 'Host: %s (instance %s)' % (host, id)
-
-        if not id:
-            res = create_cci(host, proxy=is_proxy(host))
-            cci = wait_for_cci(cci)
-        else:
-            reimage_cci(cci)
-            cci = wait_for_reload_start(cci)
-            cci = wait_for_cci(cci)
-
-            passwords = get_cci_passwords(cci)
-            (_, root_pass) = passwords[0] if passwords else (None, None)
-            print '%s password: root/%s' % (host, root_pass)
+        cci = start_provisioning(host)
+        poller.watch(cci['id'], 'reload_start', reloading(host))
+
+    # A timeout keeps the wait interruptible with ^C.
+    for _ in hosts:
+        finished.get(True, 86400)
+
+    print 'All %d hosts ready after %0.3f secs.' % (len(hosts),
+                                                    time() - started)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Creates or reloads the CCIs of a '
+                                        'swift dev cluster.')
+    parser.add_argument('--cluster', default=cluster)
+    parser.add_argument('--domain', default=domain)
+    parser.add_argument('--count', type=int, default=host_count)
+    parser.add_argument('--datacenter', default=cci_options['datacenter'])
+    parser.add_argument('--os-code', default=cci_options['os_code'])
+    parser.add_argument('--cpus', type=int, default=cci_options['cpus'])
+    parser.add_argument('--memory', type=int, default=cci_options['memory'])
+    parser.add_argument('--serial', action='store_true',
+                        help='provision one host after another')
+    args = parser.parse_args()
+
+    cluster = args.cluster
+    cci_options.update({'cpus': args.cpus,
+                        'memory': args.memory,
+                        'datacenter': args.datacenter,
+                        'os_code': args.os_code})
+    hosts = cluster_hosts(args.cluster, args.domain, args.count)
+
+    if args.serial:
+        provision_serial(hosts)
+    else:
+        provision_concurrent(hosts)